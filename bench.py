@@ -0,0 +1,153 @@
+"""
+Benchmarks for the heavier processing steps.
+
+Each benchmark compares the current implementation against
+the previous (slower) approach on synthetic (or sampled) data, e.g.:
+
+    $ python bench.py user --rows 1000000 --rows 10000000
+"""
+
+import time
+from math import sqrt
+
+import click
+import numpy as np
+import pandas as pd
+
+
+@click.group()
+def cli():
+    pass
+
+
+def timeit(f, *args, **kwargs):
+    """
+    Runs `f` once, returning its result and the elapsed wall time.
+    """
+    s = time.time()
+    result = f(*args, **kwargs)
+    return result, time.time() - s
+
+
+def synthetic_comments(n_rows, n_users=None, seed=0):
+    """
+    Generates a DataFrame shaped like the sampler's output (only the numeric columns).
+    """
+    rs = np.random.RandomState(seed)
+    n_users = n_users or max(1, n_rows//20)
+    return pd.DataFrame({
+        'userID': rs.randint(0, n_users, n_rows),
+        'createDate': rs.randint(0, 10**9, n_rows),
+        'label': rs.randint(0, 2, n_rows),
+        'recommendationCount': rs.poisson(3, n_rows),
+        'commentLength': rs.randint(1, 2000, n_rows)
+    })
+
+
+@cli.command()
+@click.option('--rows', multiple=True, type=int, default=[1000000, 10000000])
+@click.option('--legacy/--no-legacy', default=True, help='Also time the per-row implementation.')
+def user(rows, legacy):
+    """
+    User reputation features: per-row `apply` vs. the columnar pass.
+    """
+    from kalama.dredd.features.user import Featurizer
+
+    f = Featurizer(features=['userApprovalWilson', 'userAverageRecommendation'])
+    for n in rows:
+        data = synthetic_comments(n)
+        _, t_new = timeit(f._user_features, data.copy())
+        print('user features [{0} rows] columnar: {1:.2f}s'.format(n, t_new))
+
+        if legacy:
+            _, t_old = timeit(_legacy_user_features, data.copy())
+            print('user features [{0} rows] per-row:  {1:.2f}s ({2:.1f}x)'.format(n, t_old, t_old/t_new))
+
+
+@cli.command()
+@click.option('--path', default=None, help='A CSV of comments with a `commentBody` column, defaults to the notebook data.')
+@click.option('--sizes', multiple=True, type=int, default=[500, 5000, 50000])
+@click.option('--engines', multiple=True, type=click.Choice(['ihac', 'kmeans']), default=['ihac', 'kmeans'])
+@click.option('--ihac-max', type=int, default=5000, help='Skip the ihac engine above this many comments.')
+def geiger(path, sizes, engines, ihac_max):
+    """
+    Geiger clustering engines on real comments, vectorized as `highlights` does
+    (sparse tf-idf vectors from a `Vectorizer` trained on the sample).
+    """
+    import config
+    from galaxy.cluster.ihac import Hierarchy
+    from kalama.geiger import kmeans_clusters
+    from util.text import Vectorizer, normalize_html_batch
+
+    data = pd.read_csv(path or config.notebook_comments_path, usecols=['commentBody'])
+    bodies = data['commentBody'].dropna()
+
+    for n in sizes:
+        docs = normalize_html_batch(bodies.sample(min(n, len(bodies)), random_state=0).tolist())
+        vecs = Vectorizer().vectorize(docs, train=True)
+        n = vecs.shape[0]
+        for engine in engines:
+            if engine == 'ihac':
+                if n > ihac_max:
+                    print('geiger [{0} comments] ihac: skipped'.format(n))
+                    continue
+                # The hierarchy takes dense vectors (see `kalama.geiger._ihac_highlights`).
+                h = Hierarchy(metric='cosine', lower_limit_scale=0.9, upper_limit_scale=1.2)
+                _, t = timeit(lambda: (h.fit(vecs.toarray()), h.clusters(distance_threshold=0.5, with_labels=False)))
+            else:
+                _, t = timeit(kmeans_clusters, vecs, 0.5)
+            print('geiger [{0} comments, {1} terms] {2}: {3:.2f}s'.format(n, vecs.shape[1], engine, t))
+
+
+@cli.command()
+@click.option('--path', default=None, help='A CSV of comments with a `commentBody` column, defaults to the notebook data.')
+@click.option('--rows', type=int, default=100000, help='Number of comments to sample.')
+@click.option('--n-jobs', multiple=True, type=int, default=[1, 4])
+def html(path, rows, n_jobs):
+    """
+    HTML normalization: `strip_tags(html_decode(...))` per comment vs. the bulk API.
+    """
+    import config
+    from util.text import strip_tags, html_decode, normalize_html_batch
+
+    data = pd.read_csv(path or config.notebook_comments_path, usecols=['commentBody'])
+    docs = data['commentBody'].dropna().sample(min(rows, data.shape[0]), random_state=0).tolist()
+
+    old, t_old = timeit(lambda: [strip_tags(html_decode(d)) for d in docs])
+    print('html [{0} comments] strip_tags(html_decode): {1:.2f}s'.format(len(docs), t_old))
+
+    for n in n_jobs:
+        new, t_new = timeit(normalize_html_batch, docs, n_jobs=n)
+        print('html [{0} comments] normalize_html_batch (n_jobs={1}): {2:.2f}s ({3:.1f}x)'.format(
+            len(docs), n, t_new, t_old/t_new))
+
+    diffs = sum(a != b for a, b in zip(old, new))
+    print('html [{0} comments] {1} differ from the old output'.format(len(docs), diffs))
+
+
+def _legacy_user_features(data):
+    """
+    The previous groupby + per-row `apply` implementation.
+    """
+    def confidence(row):
+        ups = row['userApprovalCount']
+        downs = row['userRejectedCount']
+        n = ups + downs
+        z = 1.64485
+        p_hat = float(ups)/n
+        return (p_hat+z*z/(2*n)-z*sqrt((p_hat*(1-p_hat)+z*z/(4*n))/n))/(1+z*z/n)
+
+    data['ONE'] = 1
+    groups = data.sort('createDate').groupby(['userID'])
+    data['userApprovalCount'] = groups.label.cumsum()
+    data['userCommentCount'] = groups.ONE.cumsum()
+    data['userRecommendationCount'] = groups.recommendationCount.cumsum()
+    data['userRejectedCount'] = data['userCommentCount'] - data['userApprovalCount']
+    data['userApprovalRatio'] = data['userApprovalCount']/data['userCommentCount'].apply(float)
+    data['userAverageRecommendation'] = data['userRecommendationCount']/data['userCommentCount'].apply(float)
+    data['userApprovalWilson'] = data.apply(confidence, axis=1)
+    return data.drop(['ONE'], axis=1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -2,6 +2,23 @@ sampling = {
     'n_users': 200000
 }
 
+# Stream sampled data from the db in chunks (of roughly `chunk_size` rows)
+# rather than loading it all at once. Assets are kept in a separate table.
+# Non-incremental featurizers are fit on the first `fit_rows` rows, then transform each chunk.
+# With an incremental model (e.g. `sgd_regression`), the model is also trained chunk by chunk.
+streaming = {
+    'enabled': False,
+    'chunk_size': 50000,
+    'fit_rows': 200000
+}
+
+# Set `sampling['n_users']` to None and enable `streaming` to train on all users:
+#model = {
+    #'name': 'sgd_regression',
+    #'params': {},
+    #'eval': {}
+#}
+
 #model = {
     #'name': 'logistic_regression',
     #'params': {},
@@ -20,6 +37,24 @@ model = {
 label = 'recommendationCount'
 test_size = 0.2
 
+# How to split the data into training and testing sets: `random`, `createDate` (the latest comments are tested on),
+# or a column to split by group (e.g. `userID` or `assetID`), so no group is in both sets.
+split = {
+    'by': 'random'
+}
+
+# Sweep spec for `main.py sweep`: lists of model params and eval kwargs to try,
+# and lists of featurizers to try together (all of them if empty).
+# Results are ranked by their mean `metric` (one of the model's `evaluate` scores, higher is better).
+sweep = {
+    'params': {},
+    'eval': {},
+    'features': [],
+    'folds': 5,
+    'n_jobs': 4,
+    'metric': 'r2'
+}
+
 # keys = module names to use.
 # value = dict of kwargs to pass to the module's `featurize` func.
 features = {
@@ -39,6 +74,58 @@ features = {
     }
 }
 
+# Number of processes to run featurizers in.
+# With more than 1, featurizers which aren't frozen yet run concurrently.
+featurizing = {
+    'n_jobs': 1
+}
+
+# Tokenization for the text vectorizers.
+# `n_jobs` > 1 tokenizes in batches over a process pool,
+# `persist` saves token streams (keyed by document hash) under `data_root`,
+# so re-vectorizing the same documents doesn't tokenize them again.
+# The store is file-locked, so concurrent processes (e.g. parallel featurizers) can share it.
+tokenizing = {
+    'n_jobs': 1,
+    'chunk_size': 1000,
+    'lemma_cache_size': 200000,
+    'persist': False
+}
+
+# Streamed vectorizer training (see `util.text.Vectorizer.fit_stream`):
+# the number of documents sampled to fit the SVD on.
+vectorizing = {
+    'svd_sample': 100000
+}
+
+# How frozen data is stored.
+# `backend` is for DataFrames, one of ['chunked', 'columnar', 'csv'],
+# `other_backend` is for everything else (e.g. feature matrices), one of ['arrays', 'pickle'].
+# With `mmap_mode` (e.g. 'r'), frozen arrays (not DataFrames) are memory-mapped rather than read into memory.
+# With `budget_gb`, the least recently used freezes are evicted to keep frozen data within that size.
+# Temporary files (of in-progress or crashed writes) are garbage collected once they're `tmp_grace_hours` old
+# and their writer isn't running anymore.
+# The `chunked` backend compresses chunks of `chunk_rows` rows with `codec`
+# (one of ['auto', 'zstd', 'lz4', 'zlib', 'bz2', 'lzma', 'none'], see `util.compression`),
+# on `io_threads` threads. Its freezes are smaller, but can't be memory-mapped.
+cryo = {
+    'backend': 'columnar',
+    'other_backend': 'arrays',
+    'mmap_mode': 'r',
+    'budget_gb': None,
+    'tmp_grace_hours': 24,
+    'codec': 'auto',
+    'chunk_rows': 100000,
+    'io_threads': 4
+}
+
+# Instrumentation (see `util.profiling`): timing, memory, rows and cache hits
+# of each pipeline step, reported in the eval reports.
+# `trace_path` (or `main.py --trace`) also writes every step to a trace file.
+profiling = {
+    'enabled': True,
+    'trace_path': None
+}
 
 
 data_root = 'data/'
@@ -57,5 +144,21 @@ db = {
 # ---
 
 geiger_path = 'data/geiger/geiger_vec.pkl'
+geiger_hierarchies_path = 'data/geiger/hierarchies/'
 dredd_path = 'data/dredd/dredd_model.pkl'
+dredd_features_path = 'data/dredd/dredd_features.pkl'
 crosssample_path = 'data/crosssample/comments.json'
+notebook_comments_path = 'notebooks/comments.csv'
+
+# `cache_size` is the number of processed comment sets the server keeps in memory.
+# With a `cache_path`, they are also persisted to disk (required for `main.py warm_cache`),
+# up to `cache_disk_size` of them (the least recently used are removed).
+# With `workers` > 0, expensive filters (e.g. geiger) run in a pool of that many processes,
+# and requests give up waiting on them after `timeout` seconds.
+server = {
+    'cache_size': 256,
+    'cache_path': 'data/server/cache/',
+    'cache_disk_size': 10000,
+    'workers': 2,
+    'timeout': 30
+}
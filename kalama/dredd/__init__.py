@@ -1,7 +1,20 @@
-from sklearn.externals import joblib
-from config import dredd_path
+from kalama.dredd import scoring
 
-#m = joblib.load(dredd_path)
 
-#def score(comments):
-    #return m._m.predict()
+def score(comments, subject=''):
+    """
+    Scores a list of Commentables with the trained Dredd model (see `main.py train dredd`).
+    The model is loaded once per process.
+
+    Args:
+        | comments (list)   -- list of Commentables (replies are not scored)
+        | subject (str)     -- the body of the asset the comments are on
+    """
+    return scoring.load().score(comments, subject=subject)
+
+
+def score_discussions(threads, subject=''):
+    """
+    Scores threads of Commentables as discussions, by the mean score of each whole thread.
+    """
+    return scoring.load().score_threads(threads, subject=subject)
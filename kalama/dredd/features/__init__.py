@@ -1,41 +1,383 @@
+import os
 import config
 import importlib
+import numpy as np
+import pandas as pd
 from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
 from sklearn import preprocessing
 from sklearn.externals import joblib
+from util import cryo as cryo_, storage, profiling
 from util.cryo import cryo
+from util.logging import log
 
 
-def featurize(data):
+# Shapes and memory use of the last built feature blocks, by featurizer name.
+block_report = {}
+
+# The scalers fitted for the last built feature blocks, by featurizer name.
+scalers = {}
+
+
+def featurize(data, source=None, cache=True):
     """
     Build features the data.
+
+    Args:
+        | data (DataFrame)  -- the sampled data
+        | source (str)      -- optional, the path of the frozen sample `data` was loaded from.
+                               If given, featurizers which aren't frozen yet are run
+                               in parallel (see `run_parallel`).
+        | cache (bool)      -- whether to use cryo'd features. Without the cache, every featurizer
+                               is run in this process, so `instances` end up fitted (see `fitted`).
     """
-    scalr = preprocessing.StandardScaler()
+    if not cache:
+        feats = [_call(name, f, 'featurize', data) for name, f in instances.items()]
+        X = assemble(list(instances.keys()), feats)
+        return X, data[config.label].as_matrix()
+
+    if source is not None and config.featurizing['n_jobs'] > 1:
+        run_parallel(source, config.featurizing['n_jobs'])
 
     # Build features.
     feats = [f(data) for f in featurizers.values()]
-    X = sparse.hstack(feats)
-    X = scalr.fit_transform(X.todense())
+    X = assemble(list(featurizers.keys()), feats)
     y = data[config.label].as_matrix()
 
     return X, y
 
 
+class FittedFeatures():
+    """
+    The fitted state of the whole feature stack: each featurizer and the scaler for its block.
+    This is saved next to the Dredd model, so new data can be transformed
+    without refitting vocabularies, SVDs, scalers, etc.
+    """
+    def __init__(self, featurizers, scalers):
+        """
+        Args:
+            | featurizers (dict)    -- fitted featurizers, by name
+            | scalers (dict)        -- fitted scalers, by name
+        """
+        self.featurizers = featurizers
+        self.scalers = scalers
+
+    def transform(self, data, assets=None):
+        """
+        Build features for new data, without refitting anything on it.
+
+        Args:
+            | data (DataFrame)      -- the data
+            | assets (DataFrame)    -- optional, deduplicated `assetID`/`assetBody` table,
+                                       for when asset bodies aren't in `data`
+        """
+        feats = [_call(name, f, 'transform', data, **_asset_kwargs(f, assets))
+                 for name, f in self.featurizers.items()]
+        return assemble(list(self.featurizers.keys()), feats, fitted_scalers=self.scalers)
+
+
+def fit(data):
+    """
+    Fits every featurizer and block scaler on the data.
+
+    Returns:
+        | FittedFeatures
+    """
+    featurize(data, cache=False)
+    return fitted()
+
+
+def fitted():
+    """
+    The fitted state of the feature stack, after `fit` or `featurize(..., cache=False)`.
+    """
+    return FittedFeatures(dict(instances), dict(scalers))
+
+
+def fit_stream(chunks, assets):
+    """
+    Fits the feature stack on a sample from a stream of data chunks (see `Sampler.stream`).
+
+    Non-incremental featurizers (e.g. vocabularies) are fit on the sample.
+    Incremental featurizers are fit on no data: chunks hold complete user histories,
+    so each chunk is transformed on its own, and no per-user state accumulates across the stream.
+
+    Args:
+        | chunks (iterable)     -- DataFrames holding complete user histories, e.g. `Sampler.stream(limit=...)`
+        | assets (DataFrame)    -- deduplicated `assetID`/`assetBody` table
+
+    Returns:
+        | FittedFeatures
+    """
+    data = pd.concat(list(chunks), ignore_index=True)
+    log.info('Fitting features on {0} examples...'.format(data.shape[0]))
+
+    feats = []
+    for name, f in instances.items():
+        kwargs = _asset_kwargs(f, _chunk_assets(assets, data))
+        _call(name, f, 'fit', data.iloc[:0] if f.incremental else data, **kwargs)
+        feats.append(_call(name, f, 'transform', data, **kwargs))
+    assemble(list(instances.keys()), feats)
+    return fitted()
+
+
+def transform_stream(chunks, fitted, assets):
+    """
+    Transforms a stream of data chunks with a fitted feature stack (see `fit_stream`),
+    yielding `(X, y)` for each chunk.
+
+    Args:
+        | chunks (iterable)         -- DataFrames holding complete user histories
+        | fitted (FittedFeatures)   -- the fitted feature stack
+        | assets (DataFrame)        -- deduplicated `assetID`/`assetBody` table
+    """
+    for i, chunk in enumerate(chunks):
+        log.info('Transforming chunk {0} ({1} rows)...'.format(i, chunk.shape[0]))
+        X = fitted.transform(chunk, assets=_chunk_assets(assets, chunk))
+        yield X, chunk[config.label].values
+
+
+def _call(name, f, method, data, **kwargs):
+    """
+    Calls a featurizer method on the data, profiled as `features.<name>.<method>`.
+    """
+    with profiling.span('features.{0}.{1}'.format(name, method), rows=profiling.num_rows(data)):
+        return getattr(f, method)(data, **kwargs)
+
+
+def _asset_kwargs(f, assets):
+    return {'assets': assets} if assets is not None and getattr(f, 'uses_assets', False) else {}
+
+
+def _chunk_assets(assets, data):
+    """
+    Only the assets referenced in the data.
+    """
+    return assets[assets['assetID'].isin(data['assetID'].unique())]
+
+
+def featurize_stream(chunks, assets, fit_rows=None):
+    """
+    Build features from a stream of data chunks (see `Sampler.stream`),
+    with assets kept in a separate, deduplicated table.
+
+    Incremental featurizers process each chunk as it arrives.
+    The others (e.g. vocabularies) are fit on the first `fit_rows` rows, of which only
+    their columns are held, and then transform each chunk as it arrives.
+    Every block is kept sparse.
+
+    Args:
+        | chunks (iterable)     -- DataFrames holding complete user histories
+        | assets (DataFrame)    -- deduplicated `assetID`/`assetBody` table
+        | fit_rows (int)        -- the number of rows to fit the non-incremental featurizers on,
+                                   defaults to `config.streaming`
+    """
+    fit_rows = fit_rows or config.streaming['fit_rows']
+    blocks = {name: [] for name in instances}
+    pending = {name: f for name, f in instances.items() if not f.incremental}
+    columns = sorted({c for f in pending.values() for c in f.columns})
+    buffered, n_buffered = [], 0
+    labels = []
+
+    def transform(data):
+        for name, f in pending.items():
+            kwargs = _asset_kwargs(f, _chunk_assets(assets, data))
+            blocks[name].append(sparse.csr_matrix(_call(name, f, 'transform', data, **kwargs)))
+
+    def fit():
+        data = pd.concat(buffered, ignore_index=True)
+        log.info('Fitting {0} on {1} examples...'.format(sorted(pending), data.shape[0]))
+        for name, f in pending.items():
+            _call(name, f, 'fit', data, **_asset_kwargs(f, assets))
+        for part in buffered:
+            transform(part)
+        del buffered[:]
+
+    fitted = not pending
+    for i, chunk in enumerate(chunks):
+        log.info('Featurizing chunk {0} ({1} rows)...'.format(i, chunk.shape[0]))
+        for name, f in instances.items():
+            if f.incremental:
+                blocks[name].append(sparse.csr_matrix(_call(name, f, 'featurize', chunk)))
+        labels.append(chunk[config.label].values)
+
+        if fitted:
+            transform(chunk[columns])
+        else:
+            buffered.append(chunk[columns])
+            n_buffered += chunk.shape[0]
+            if n_buffered >= fit_rows:
+                fit()
+                fitted = True
+
+    if not fitted and buffered:
+        fit()
+
+    # Keep the same column order as `featurize`.
+    feats = [sparse.vstack(blocks[name], format='csr') for name in instances]
+    X = assemble(list(instances.keys()), feats)
+    y = np.concatenate(labels)
+
+    return X, y
+
+
+def freeze_blocks(data, source=None):
+    """
+    Makes sure every featurizer's block of features is frozen.
+
+    Returns:
+        | dict              -- the frozen blocks' paths, by featurizer name
+    """
+    if source is not None and config.featurizing['n_jobs'] > 1:
+        run_parallel(source, config.featurizing['n_jobs'])
+
+    for f in featurizers.values():
+        if not f.frozen():
+            f(data)
+    return {name: f.fpath() for name, f in featurizers.items()}
+
+
+def run_parallel(source, n_jobs):
+    """
+    Runs the featurizers which aren't frozen yet concurrently, in a process pool.
+
+    Rather than pickling the sampled data to each worker, workers load
+    only the columns they need from the frozen sample.
+    Their results are frozen, so they are just defrosted afterwards.
+
+    Args:
+        | source (str)      -- the path of the frozen sample
+        | n_jobs (int)      -- the maximum number of worker processes
+    """
+    pending = [name for name, f in featurizers.items() if not f.frozen()]
+    if len(pending) < 2 or not os.path.exists(source):
+        return
+
+    log.info('Running featurizers {0} in parallel...'.format(pending))
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(pending))) as pool:
+        fpaths = list(pool.map(_run_featurizer, pending, [source]*len(pending)))
+
+    # Defrost these rather than re-running them, even if the stage is being refreshed.
+    cryo_.fresh.update(fpaths)
+
+
+def _run_featurizer(name, source):
+    """
+    Runs (and freezes) a single featurizer in a worker process.
+    """
+    # The pool's workers can't start pools of their own.
+    config.tokenizing = dict(config.tokenizing, n_jobs=1)
+
+    f = featurizers[name]
+    columns = list(instances[name].columns)
+    if getattr(instances[name], 'uses_assets', False):
+        columns.append('assetBody')
+    data = storage.load(source, columns=columns)
+    f(data)
+    return f.fpath()
+
+
+def assemble(names, feats, dense_threshold=0.5, fitted_scalers=None):
+    """
+    Scales each featurizer's block of features and stacks them into a single CSR matrix,
+    without ever densifying the full matrix.
+
+    Unless `fitted_scalers` are given, scalers are fitted (see `fit_scalers`)
+    and kept in `scalers`, and the blocks are described in `block_report`.
+
+    Args:
+        | names (list)              -- the featurizer names
+        | feats (list)              -- the feature blocks (sparse matrices or arrays)
+        | dense_threshold (float)   -- the density above which a block is treated as dense
+        | fitted_scalers (dict)     -- optional, already-fitted scalers by name to use instead of fitting new ones
+    """
+    if fitted_scalers is None:
+        block_report.clear()
+        for name, block in zip(names, feats):
+            block_report[name] = _block_stats(block)
+
+        for name, stats in block_report.items():
+            log.info('Features [{0}]: {1} ({2} MB, density {3:.3f})'.format(
+                name, stats['shape'], round(stats['bytes']/1e6, 1), stats['density']))
+
+        fitted_scalers = fit_scalers(names, feats, dense_threshold)
+        scalers.clear()
+        scalers.update(fitted_scalers)
+
+    blocks = []
+    for name, block in zip(names, feats):
+        scalr = fitted_scalers[name]
+        if scalr.with_mean:
+            blocks.append(sparse.csr_matrix(scalr.transform(_dense(block))))
+        else:
+            blocks.append(scalr.transform(sparse.csr_matrix(block, dtype=float)))
+    return sparse.hstack(blocks, format='csr')
+
+
+def fit_scalers(names, feats, dense_threshold=0.5):
+    """
+    Fits a scaler per featurizer block, returned as a dict by name.
+
+    Dense blocks (with density above `dense_threshold`, e.g. the user features) are small,
+    so they are centered and scaled. Sparse blocks (e.g. bag-of-words) are only scaled,
+    since centering would destroy their sparsity.
+    """
+    fitted = {}
+    for name, block in zip(names, feats):
+        if _density(block) > dense_threshold:
+            fitted[name] = preprocessing.StandardScaler().fit(_dense(block))
+        else:
+            fitted[name] = preprocessing.StandardScaler(with_mean=False).fit(sparse.csr_matrix(block, dtype=float))
+    return fitted
+
+
+def _dense(block):
+    return block.toarray() if sparse.issparse(block) else np.asarray(block, dtype=float)
+
+
+def _density(block):
+    n = block.shape[0] * block.shape[1]
+    if not n:
+        return 0.
+    nnz = block.nnz if sparse.issparse(block) else np.count_nonzero(block)
+    return nnz/float(n)
+
+
+def _block_stats(block):
+    """
+    Shape, format and memory use of a feature block.
+    """
+    if sparse.issparse(block):
+        buffers = {'coo': ['data', 'row', 'col']}.get(block.format, ['data', 'indices', 'indptr'])
+        nbytes = sum(getattr(block, b).nbytes for b in buffers)
+        fmt = block.format
+    else:
+        nbytes = np.asarray(block).nbytes
+        fmt = 'dense'
+    return {
+        'shape': list(block.shape),
+        'format': fmt,
+        'bytes': int(nbytes),
+        'density': _density(block)
+    }
+
 
-def _cryo_func(path, featurizer):
+def _cryo_func(name, path, featurizer):
     """
     Build separate cryo'd func for featurizing data.
     We don't cryo the aggregate features because we want to be able to hot-swap featurizers.
     """
-    @cryo('features', path, ['sampling', path], dtype='other')
+    @cryo('features', path, [path], dtype='other', upstream=['sample'],
+          version=cryo_.source_version(type(featurizer)))
     def _featurize(data):
-        return featurizer.featurize(data)
+        return _call(name, featurizer, 'featurize', data)
 
     return _featurize
 
 
 # Load featurizers specified in the config.
 featurizers = {}
+instances = {}
 for name, kwargs in config.features.items():
     # This assumes that the keys for feature configs are the same
     # as their module names, e.g. features.foo's config is at config.features['foo'].
@@ -43,5 +385,6 @@ for name, kwargs in config.features.items():
     path = 'features.{0}'.format(name)
     mod = importlib.import_module('{0}.{1}'.format(root, path))
     featurizer = mod.Featurizer(**kwargs)
-    featurizers[name] = _cryo_func(path, featurizer)
+    instances[name] = featurizer
+    featurizers[name] = _cryo_func(name, path, featurizer)
 
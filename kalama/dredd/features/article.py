@@ -1,51 +1,79 @@
 import numpy as np
-from util import text
-from scipy.spatial.distance import cosine
-from scipy.sparse import vstack
+import pandas as pd
+from util import text, distance
 
 
 class Featurizer():
+    incremental = False
+    columns = ['assetID', 'commentBody']
+
+    # Also needs asset bodies, either as an `assetBody` column or a separate `assets` table.
+    uses_assets = True
+
     def __init__(self, metric='cosine', hash=True):
         # Use a hashing vectorizer to reduce memory load.
         self.vectr = text.Vectorizer(hash=hash)
         self.metric = metric
 
-    def featurize(self, data):
+    def featurize(self, data, assets=None):
         """
-        Calculate asset relevance by cosine distance.
+        Calculate asset relevance by cosine similarity
+        (or by distance, for the other `metric`s).
 
         The vectorizer is trained on the assets rather than the comments.
+
+        Args:
+            | data (DataFrame)      -- the comment data
+            | assets (DataFrame)    -- optional, deduplicated `assetID`/`assetBody` table.
+                                       If not specified, assets are taken from `data`.
         """
-        # Get only unique assets.
-        deduped = data.drop_duplicates(subset=['assetID'], inplace=False)
+        deduped = self._assets(data, assets)
 
         print('Vectorizing assets...')
 
         # Vectorize assets.
         asset_vecs = self.vectr.vectorize(deduped['assetBody'], train=True)
 
-        print('Mapping assets...')
+        return self._relevance(data, deduped, asset_vecs)
+
+    def fit(self, data, assets=None):
+        """
+        Trains the vectorizer on the assets.
+        """
+        self.vectr.fit(self._assets(data, assets)['assetBody'])
+        return self
+
+    def transform(self, data, assets=None):
+        """
+        Like `featurize`, but uses the already-trained vectorizer.
+        """
+        deduped = self._assets(data, assets)
+        asset_vecs = self.vectr.vectorize(deduped['assetBody'])
+        return self._relevance(data, deduped, asset_vecs)
 
-        # Map asset ids to their vector's index.
-        asset_map = {}
-        asset_ids = list(deduped['assetID'])
-        for i, id in enumerate(asset_ids):
-            #asset_map[id] = uniq_asset_vecs[i]
-            asset_map[id] = i
+    def _assets(self, data, assets):
+        # Get only unique assets.
+        if assets is None:
+            return data.drop_duplicates(subset=['assetID'], inplace=False)
+        return assets
+
+    def _relevance(self, data, deduped, asset_vecs):
+        print('Mapping assets...')
 
         # Map comments to their asset's vector index.
-        comment_to_asset_indices = [asset_map[id] for id in data.assetID]
+        asset_index = pd.Index(deduped['assetID'])
+        comment_to_asset_indices = asset_index.get_indexer(data['assetID'])
+        if (comment_to_asset_indices < 0).any():
+            raise ValueError('Some comments reference assets which are not in the assets table')
 
         print('Vectorizing comments...')
         comment_vecs = self.vectr.vectorize(data['commentBody'])
 
         print('Calculating distances...')
-        # Is there a faster way to calculate row-wise distances?
-        sims = [1 - cosine(comment_vecs[i], asset_vecs[asset_map[id]]) for i, id in enumerate(data.assetID)]
-        sims = np.array(sims)
+        dists = distance.rowwise(comment_vecs, asset_vecs, comment_to_asset_indices, metric=self.metric)
 
-        # Not sure how these nans are resulting, but set them to 0.
-        sims = np.nan_to_num(sims)
+        # Cosine is reported as a similarity, the other metrics as distances.
+        feats = 1 - dists if self.metric == 'cosine' else dists
 
         # Make it 2D.
-        return np.reshape(sims, (-1, 1))
+        return np.reshape(feats, (-1, 1))
@@ -2,8 +2,18 @@ from util import text
 
 
 class Featurizer():
+    incremental = False
+    columns = ['commentBody']
+
     def __init__(self):
         self.vectr = text.Vectorizer()
 
     def featurize(self, data):
         return self.vectr.vectorize(data['commentBody'], train=True)
+
+    def fit(self, data):
+        self.vectr.fit(data['commentBody'])
+        return self
+
+    def transform(self, data):
+        return self.vectr.vectorize(data['commentBody'])
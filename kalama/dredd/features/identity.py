@@ -6,10 +6,19 @@ class Featurizer():
     The identity featurizer selects the specified features
     from the original data, without affecting them.
     """
+    incremental = True
+
     def __init__(self, features=[]):
         self.features = features
+        self.columns = features
 
     def featurize(self, data):
         # TO DO this would need to create the necessary indicator values
         # for non-numerical data.
         return sparse.coo_matrix(data[self.features])
+
+    def fit(self, data):
+        return self
+
+    def transform(self, data):
+        return self.featurize(data)
@@ -2,52 +2,193 @@
 Handles processing and construction of features.
 """
 
-from math import sqrt
+import numpy as np
+import pandas as pd
 from scipy import sparse
 
 
 class Featurizer():
-    def __init__(self, features=[]):
+    # Cumulative features only need each user's full history,
+    # so chunks which hold complete user histories can be featurized independently.
+    incremental = True
+    columns = ['userID', 'createDate', 'label', 'recommendationCount']
+
+    def __init__(self, features=[], z=1.64485):
+        """
+        Args:
+            | features (list)   -- the user features to select
+            | z (float)         -- the z value for the Wilson score, defaults to 95% confidence
+        """
         self.features = features
+        self.z = z
+        self.history = None
 
     def featurize(self, data):
-        data = self._user_features(data)
+        """
+        Fits on the data and returns its features.
+        The data is assumed to hold each user's full history.
+        """
+        self.fit(data)
+        return self._select(self._user_features(data))
 
-        # Select only the specified features.
-        data = data[self.features]
+    def fit(self, data):
+        """
+        Remembers each user's totals, so that new comments (see `transform`)
+        are featurized on top of the user's history.
+        """
+        self.history = self._totals(data)
+        return self
+
+    def _totals(self, data):
+        labels = data['label'].values.astype(float)
+        return pd.DataFrame({
+            'approvals': np.nan_to_num(labels),
+            'moderated': ~np.isnan(labels),
+            'recommendations': data['recommendationCount'].values,
+            'comments': 1
+        }, index=data['userID'].values).groupby(level=0).sum()
 
-        return sparse.coo_matrix(data)
+    def transform(self, data):
+        """
+        Features for new comments, continuing each user's history from the fitted data.
+        """
+        return self._select(self._user_features(data, history=self.history))
 
-    def _user_features(self, data):
+    def _select(self, data):
+        # Select only the specified features.
+        return sparse.coo_matrix(data[self.features])
+
+    def _user_features(self, data, history=None):
         """
-        User (reputation) features
+        User (reputation) features.
+
+        These are cumulative per user, ordered by the comment's creation date.
+        Everything is computed in a single columnar pass over the data
+        sorted by `(userID, createDate)`.
+
+        Comments without a `label` (e.g. new comments being scored) haven't been moderated yet:
+        they count towards the user's comments, but not their approvals or rejections.
+
+        Args:
+            | data (DataFrame)      -- the comment data
+            | history (DataFrame)   -- optional, prior per-user totals to start from (see `fit`)
         """
-        data['ONE'] = 1
-        groups = data.sort('createDate').groupby(['userID'])
+        order = _user_order(data['userID'].values, data['createDate'].values)
+        starts = _group_starts(data['userID'].values[order])
 
         # The `label` column is whether or not the comment was approved.
-        data['userApprovalCount'] = groups.label.cumsum()
-        data['userCommentCount'] = groups.ONE.cumsum()
-        data['userRecommendationCount'] = groups.recommendationCount.cumsum()
-        data['userRejectedCount'] = data['userCommentCount'] - data['userApprovalCount']
-        data['userApprovalRatio'] = data['userApprovalCount']/data['userCommentCount'].apply(float)
-        data['userAverageRecommendation'] = data['userRecommendationCount']/data['userCommentCount'].apply(float)
-        data['userApprovalWilson'] = data.apply(self._confidence, axis=1)
+        labels = data['label'].values.astype(float)
+        approvals = _grouped_cumsum(np.nan_to_num(labels), order, starts)
+        moderated = _grouped_cumsum(~np.isnan(labels), order, starts)
+        recommendations = _grouped_cumsum(data['recommendationCount'].values, order, starts)
+        counts = _grouped_cumsum(np.ones(len(data)), order, starts)
+
+        if history is not None:
+            prior = _prior(history, data['userID'].values)
+            approvals += prior['approvals'].values
+            moderated += prior.get('moderated', prior['comments']).values
+            recommendations += prior['recommendations'].values
+            counts += prior['comments'].values
+
+        # Users with no moderated comments yet get no approval ratio/score.
+        judged = np.maximum(moderated, 1)
 
-        # Cleanup
-        data = data.drop(['ONE'], axis=1)
+        data['userApprovalCount'] = approvals
+        data['userCommentCount'] = counts
+        data['userRecommendationCount'] = recommendations
+        data['userRejectedCount'] = moderated - approvals
+        data['userApprovalRatio'] = approvals/judged
+        data['userAverageRecommendation'] = recommendations/counts
+        data['userApprovalWilson'] = np.where(moderated > 0, wilson(approvals, judged, z=self.z), 0)
 
         return data
 
-    def _confidence(self, row):
-        """
-        Wilson Score Confidence Interval
-        Adapted from: <https://possiblywrong.wordpress.com/2011/06/05/reddits-comment-ranking-algorithm/>
-        """
-        ups = row['userApprovalCount']
-        downs = row['userRejectedCount']
-        n = ups + downs
-        z = 1.64485  # 95% confidence interval
-        p_hat = float(ups)/n
-        return (p_hat+z*z/(2*n)-z*sqrt((p_hat*(1-p_hat)+z*z/(4*n))/n))/(1+z*z/n)
 
+def wilson(ups, n, z=1.64485):
+    """
+    Lower bound of the Wilson Score Confidence Interval, vectorized.
+    Adapted from: <https://possiblywrong.wordpress.com/2011/06/05/reddits-comment-ranking-algorithm/>
+
+    Args:
+        | ups (ndarray)     -- the number of positive outcomes
+        | n (ndarray)       -- the total number of outcomes (must be > 0)
+        | z (float)         -- the z value, defaults to 95% confidence
+    """
+    ups = np.asarray(ups, dtype=float)
+    n = np.asarray(n, dtype=float)
+    z2 = z*z
+    p_hat = ups/n
+    return (p_hat + z2/(2*n) - z*np.sqrt((p_hat*(1-p_hat) + z2/(4*n))/n))/(1 + z2/n)
+
+
+def _prior(history, users):
+    """
+    Each user's fitted totals (zero for users with no history).
+    Users are cast to the dtype of the fitted users, so e.g. ids given as strings still match;
+    ids which can't be cast (e.g. display names) have no history.
+    """
+    if history.index.dtype.kind in 'iuf':
+        users = _numeric(users, history.index.dtype)
+    return history.reindex(users).fillna(0)
+
+
+def _numeric(values, dtype):
+    """
+    Casts values to a numeric dtype; if some can't be cast,
+    all are cast to float, with NaN for those which can't.
+    (`pd.to_numeric` needs pandas 0.17.)
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'iuf':
+        return values
+    try:
+        return values.astype(dtype)
+    except (ValueError, TypeError, OverflowError):
+        return np.array([_float(v) for v in values], dtype=float)
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError, OverflowError):
+        return np.nan
+
+
+def _user_order(users, dates):
+    """
+    Returns the permutation which sorts rows by `(userID, createDate)`.
+    Two stable sorts are used so this works on object (e.g. date string) columns too.
+    """
+    order = np.argsort(dates, kind='mergesort')
+    return order[np.argsort(users[order], kind='mergesort')]
+
+
+def _group_starts(sorted_keys):
+    """
+    Boolean mask marking the first row of each group in a sorted key array.
+    """
+    starts = np.empty(len(sorted_keys), dtype=bool)
+    starts[:1] = True
+    starts[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    return starts
+
+
+def _grouped_cumsum(values, order, starts):
+    """
+    Cumulative sum of `values` within each group, returned in the original row order.
+
+    Args:
+        | values (ndarray)  -- the values to sum, in original row order
+        | order (ndarray)   -- the permutation sorting rows into groups
+        | starts (ndarray)  -- boolean mask of group starts (in sorted order)
+    """
+    vals = np.asarray(values, dtype=float)[order]
+    totals = np.cumsum(vals)
+
+    # Subtract the running total as it stood just before each group began.
+    offsets = (totals - vals)[starts]
+    sums = totals - offsets[np.cumsum(starts) - 1]
+
+    out = np.empty_like(sums)
+    out[order] = sums
+    return out
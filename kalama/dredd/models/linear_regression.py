@@ -1,14 +1,20 @@
 from sklearn import linear_model
 from sklearn import metrics
+from util.profiling import profiled, num_rows
 
 
 class Model():
     def __init__(self):
         self._m = linear_model.LinearRegression()
 
+    @profiled('model.train', rows=lambda self, X, y: num_rows(X))
     def train(self, X_train, y_train):
         self._m.fit(X_train, y_train)
 
+    def predict(self, X):
+        return self._m.predict(X)
+
+    @profiled('model.evaluate', rows=lambda self, X, y, *args: num_rows(X))
     def evaluate(self, X_test, y_test):
         y_pred = self._m.predict(X_test)
 
@@ -1,15 +1,24 @@
 import pandas as pd
 from sklearn import linear_model
 from sklearn import metrics
+from util.profiling import profiled, num_rows
 
 
 class Model():
     def __init__(self):
         self._m = linear_model.LogisticRegression('l2', class_weight={1: 1})
 
+    @profiled('model.train', rows=lambda self, X, y: num_rows(X))
     def train(self, X_train, y_train):
         self._m.fit(X_train, y_train)
 
+    def predict(self, X):
+        """
+        Probabilities of the positive (1) class.
+        """
+        return self._m.predict_proba(X)[:,1]
+
+    @profiled('model.evaluate', rows=lambda self, X, y, *args: num_rows(X))
     def evaluate(self, X_test, y_test, threshold=None):
         if threshold is None: y_pred = self._m.predict(X_test)
         else:
@@ -0,0 +1,47 @@
+import numpy as np
+from sklearn import linear_model
+from sklearn import metrics
+from util.profiling import profiled, num_rows
+
+
+class Model():
+    """
+    Logistic regression fit by stochastic gradient descent.
+
+    This trains incrementally: each call to `train` updates the model
+    with another chunk of data, so it can be trained out-of-core.
+    """
+    incremental = True
+
+    def __init__(self, classes=[0, 1], **params):
+        self.classes = np.array(classes)
+        self._m = linear_model.SGDClassifier(loss='log', **params)
+
+    @profiled('model.train', rows=lambda self, X, y: num_rows(X))
+    def train(self, X_train, y_train):
+        self._m.partial_fit(X_train, y_train, classes=self.classes)
+
+    def predict(self, X):
+        """
+        Probabilities of the positive (1) class.
+        """
+        return self._m.predict_proba(X)[:,1]
+
+    @profiled('model.evaluate', rows=lambda self, X, y, *args: num_rows(X))
+    def evaluate(self, X_test, y_test, threshold=0.5):
+        return self.metrics(y_test, self.predict(X_test), threshold=threshold)
+
+    def metrics(self, y_test, y_prob, threshold=0.5):
+        y_pred = (np.asarray(y_prob) > threshold).astype(int)
+
+        accuracy = metrics.accuracy_score(y_test, y_pred)
+        precision = metrics.precision_score(y_test, y_pred)
+        recall = metrics.recall_score(y_test, y_pred)
+        roc_auc = metrics.roc_auc_score(y_test, y_prob)
+        return {
+            'accuracy': accuracy,
+            'precision': precision,
+            'recall': recall,
+            'roc_auc': roc_auc,
+            'coef': list(self._m.coef_[0])
+        }
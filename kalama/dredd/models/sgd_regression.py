@@ -0,0 +1,34 @@
+import numpy as np
+from sklearn import linear_model
+from sklearn import metrics
+from util.profiling import profiled, num_rows
+
+
+class Model():
+    """
+    Linear regression fit by stochastic gradient descent.
+
+    This trains incrementally: each call to `train` updates the model
+    with another chunk of data, so it can be trained out-of-core.
+    """
+    incremental = True
+
+    def __init__(self, **params):
+        self._m = linear_model.SGDRegressor(**params)
+
+    @profiled('model.train', rows=lambda self, X, y: num_rows(X))
+    def train(self, X_train, y_train):
+        self._m.partial_fit(X_train, np.asarray(y_train, dtype=float))
+
+    def predict(self, X):
+        return self._m.predict(X)
+
+    @profiled('model.evaluate', rows=lambda self, X, y, *args: num_rows(X))
+    def evaluate(self, X_test, y_test):
+        return self.metrics(y_test, self.predict(X_test))
+
+    def metrics(self, y_test, y_pred):
+        r2 = metrics.r2_score(y_test, y_pred)
+        return {
+            'r2': r2
+        }
@@ -1,3 +1,4 @@
+import pymysql
 import pandas as pd
 from .datastore import db
 
@@ -18,6 +19,86 @@ class Sampler():
         log.info('Loading {0} users'.format(config.sampling['n_users']))
         return pd.read_sql(self.query_by_user(), db)
 
+    @cryo('sampling', 'users', ['sampling'])
+    def users(self):
+        """
+        The random sample of user ids, frozen so that
+        streamed comments and assets are drawn from the same users.
+        """
+        log.info('Sampling {0} users'.format(config.sampling['n_users']))
+        return pd.read_sql(self.random_sample_of_users_query(), db)
+
+    @cryo('sampling', 'assets', ['sampling'], upstream=['users'])
+    def assets(self):
+        """
+        The assets commented on by the sampled users, deduplicated by `assetID`.
+        """
+        self._load_users()
+        log.info('Loading assets')
+        return pd.read_sql(self.sampled_assets_query(), db)
+
+    def stream(self, chunk_size=None, limit=None):
+        """
+        Yields comment data for the sampled users in chunks, using a server-side cursor
+        so the full result is never held in memory.
+
+        Rows are ordered by `(userID, createDate)` and chunks are only cut at user boundaries,
+        so every chunk holds complete user histories.
+
+        Asset bodies are not included; use `assets` for those.
+
+        Args:
+            | chunk_size (int)  -- approximate number of rows per chunk, defaults to `config.streaming`
+            | limit (int)       -- optional, the maximum number of rows to stream
+                                   (the last user's history may then be incomplete)
+        """
+        chunk_size = chunk_size or config.streaming['chunk_size']
+        self._load_users()
+
+        query = self.query_by_sampled_users()
+        if limit is not None:
+            query += 'LIMIT {0}'.format(int(limit))
+
+        cursor = db.cursor(pymysql.cursors.SSCursor)
+        cursor.execute(query)
+        columns = [d[0] for d in cursor.description]
+        uid = columns.index('userID')
+
+        try:
+            pending = []
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                rows = pending + list(rows)
+
+                # Hold back the last user's rows, they may continue in the next fetch.
+                cut = len(rows)
+                last = rows[-1][uid]
+                while cut > 0 and rows[cut-1][uid] == last:
+                    cut -= 1
+
+                pending = rows[cut:]
+                if cut > 0:
+                    yield pd.DataFrame(rows[:cut], columns=columns)
+
+            if pending:
+                yield pd.DataFrame(pending, columns=columns)
+        finally:
+            cursor.close()
+
+    def _load_users(self):
+        """
+        Loads the sampled user ids into a temporary table for the streaming queries.
+        """
+        users = self.users()
+        cursor = db.cursor()
+        cursor.execute('DROP TEMPORARY TABLE IF EXISTS sampled_users')
+        cursor.execute('CREATE TEMPORARY TABLE sampled_users (userID BIGINT PRIMARY KEY)')
+        cursor.executemany('INSERT INTO sampled_users (userID) VALUES (%s)',
+                           [(int(id),) for id in users['userID']])
+        cursor.close()
+
     def query_by_user(self):
         """
         Returns comment data for random subset of n_users.
@@ -46,7 +127,57 @@ class Sampler():
                    self.comment_taxonomy_query(),
                    self.asset_query())
 
+    def query_by_sampled_users(self):
+        """
+        Returns comment data (without asset bodies) for the users in the `sampled_users` table,
+        ordered by user and date.
+        """
+
+        return """
+        SELECT {0}
+        FROM crnr_comment
+        JOIN sampled_users
+        ON (sampled_users.userID = crnr_comment.userID)
+
+        JOIN assets
+        ON (assets.assetID = crnr_comment.assetID)
+
+        LEFT JOIN ( {1} ) comment_taxonomy
+        ON (comment_taxonomy.commentID = crnr_comment.commentID)
+
+        WHERE
+          (statusID = 2 OR statusId = 3) AND
+          (commentBody IS NOT NULL) AND
+          (commentBody != '') AND
+          (assetBody IS NOT NULL) AND
+          (assetBody != '')
+        ORDER BY crnr_comment.userID, crnr_comment.createDate
+        """.format(self.comment_features(),
+                   self.comment_taxonomy_query())
+
+    def sampled_assets_query(self):
+        return """
+        SELECT assets.assetID as assetID, assetBody
+        FROM assets
+        JOIN (
+            SELECT DISTINCT(assetID)
+            FROM crnr_comment
+            JOIN sampled_users
+            ON (sampled_users.userID = crnr_comment.userID)
+        ) sampled_assets
+        ON (sampled_assets.assetID = assets.assetID)
+        WHERE
+          (assetBody IS NOT NULL) AND
+          (assetBody != '')
+        """
+
     def all_features(self):
+        return """
+        {0},
+        assetBody
+        """.format(self.comment_features())
+
+    def comment_features(self):
         return """
         crnr_comment.commentID as commentID,
         crnr_comment.userID as userID,
@@ -63,7 +194,6 @@ class Sampler():
         userDisplayName,
         userLocation,
         taxonomyList,
-        assetBody,
         crnr_comment.statusID as statusID,
         CASE
           WHEN statusID = 2 THEN 1
@@ -72,6 +202,14 @@ class Sampler():
         """
 
     def random_sample_of_users_query(self):
+        # No `n_users` means all users.
+        if config.sampling['n_users'] is None:
+            return """
+            SELECT
+              distinct(userID)
+            FROM crnr_comment
+            """
+
         return """
         SELECT
           distinct(userID)
@@ -0,0 +1,107 @@
+"""
+Scores comments with a trained Dredd model.
+
+A `Scorer` pairs the trained model with the feature stack fitted
+while training it (see `features.FittedFeatures`),
+so that new comments are featurized without refitting anything.
+"""
+
+import numpy as np
+import pandas as pd
+
+from config import dredd_path, dredd_features_path
+from util.morph import flatten
+from util.registry import registry
+
+
+def load():
+    """
+    A Scorer for the trained model and feature stack (see `main.py train dredd`).
+    Both are loaded once per process, and reloaded if their files change.
+    """
+    return Scorer(registry.get(dredd_path), registry.get(dredd_features_path))
+
+
+class Scorer():
+    def __init__(self, model, fitted):
+        """
+        Args:
+            | model (Model)                 -- the trained model
+            | fitted (FittedFeatures)       -- the fitted feature stack
+        """
+        self.model = model
+        self.fitted = fitted
+
+    def score_frame(self, data):
+        """
+        Scores a DataFrame of comments with the same columns as the sampled data.
+        """
+        X = self.fitted.transform(data)
+        return self.model.predict(X)
+
+    def score(self, comments, subject=''):
+        """
+        Scores a list of Commentables on the same subject,
+        setting their `dredd_score` and returning the scores.
+        """
+        if not comments:
+            return np.array([])
+        scores = self.score_frame(to_frame(comments, subject))
+        for c, s in zip(comments, scores):
+            c.dredd_score = float(s)
+        return scores
+
+    def score_threads(self, threads, subject=''):
+        """
+        Scores threads of Commentables as discussions: each top-level comment's
+        `dredd_score` is the mean score of its whole thread.
+        """
+        flat = [list(flatten([t])) for t in threads]
+        scores = self.score([c for thread in flat for c in thread], subject=subject)
+
+        i = 0
+        thread_scores = []
+        for t, thread in zip(threads, flat):
+            t.dredd_score = float(np.mean(scores[i:i+len(thread)]))
+            thread_scores.append(t.dredd_score)
+            i += len(thread)
+        return np.array(thread_scores)
+
+
+def to_frame(comments, subject=''):
+    """
+    Converts Commentables into a DataFrame with the columns the featurizers expect.
+
+    New comments haven't been moderated yet, so they have no `label`,
+    and they have no recommendations yet. Users are matched to the training data's by `user_id`
+    (NYT comments collected by `nyt_reddit.py` have one). Comments without one (e.g. reddit comments)
+    are keyed by `author`, which doesn't match any trained user, so their user features have no history.
+    """
+    bodies = [c.body for c in comments]
+    return pd.DataFrame({
+        'commentBody': bodies,
+        'commentLength': [len(b) for b in bodies],
+        # As strings, so they sort together; `features.user` casts them back to the trained ids' dtype.
+        'userID': [str(c.author if c.user_id is None else c.user_id) for c in comments],
+        'createDate': [str(getattr(c, 'created_at', '')) for c in comments],
+        'assetID': 0,
+        'assetBody': subject,
+        'label': np.nan,
+        'recommendationCount': 0,
+        'editorsSelection': 0
+    })
+
+
+def score_records(scorer, records):
+    """
+    Scores a batch of raw comment records (dicts with the sampled data's columns).
+    Missing columns are filled in with the same defaults as `to_frame`.
+    """
+    data = pd.DataFrame(records)
+    defaults = {'label': np.nan, 'recommendationCount': 0, 'editorsSelection': 0, 'assetID': 0, 'assetBody': ''}
+    for col, val in defaults.items():
+        if col not in data:
+            data[col] = val
+    if 'commentLength' not in data:
+        data['commentLength'] = data['commentBody'].map(len)
+    return scorer.score_frame(data)
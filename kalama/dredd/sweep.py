@@ -0,0 +1,112 @@
+"""
+Hyperparameter, evaluation threshold and feature subset sweeps,
+evaluated by k-fold cross-validation in parallel.
+
+The features stage is only run once: every configuration reuses the per-featurizer
+blocks frozen by `cryo`, which the workers defrost memory-mapped.
+"""
+
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+import config
+from kalama.dredd import models, features
+from util import eval, storage
+from util.logging import log
+
+
+def grid(spec):
+    """
+    Expands a sweep spec into a list of configurations.
+
+    Args:
+        | spec (dict)   -- with (optional) keys:
+                            - `params`: dict of model param name -> list of values
+                            - `eval`: dict of eval kwarg name -> list of values
+                            - `features`: list of featurizer name lists (defaults to all featurizers)
+
+    Returns:
+        | list          -- of dicts with `params`, `eval` and `features` keys
+    """
+    params = _product(spec.get('params', {}))
+    evals = _product(spec.get('eval', {}))
+    subsets = spec.get('features') or [list(features.featurizers.keys())]
+    return [{'params': p, 'eval': e, 'features': list(f)}
+            for p, e, f in itertools.product(params, evals, subsets)]
+
+
+def run(data, spec, folds=5, n_jobs=1, source=None):
+    """
+    Evaluates every configuration of the spec with k-fold cross-validation.
+
+    Args:
+        | data (DataFrame)  -- the sampled data
+        | spec (dict)       -- the sweep spec (see `grid`)
+        | folds (int)       -- number of folds
+        | n_jobs (int)      -- number of worker processes
+        | source (str)      -- optional, the frozen sample's path (to featurize in parallel)
+
+    Returns:
+        | list              -- a result dict per configuration
+    """
+    configs = grid(spec)
+    paths = features.freeze_blocks(data, source=source)
+    y = data[config.label].values
+    splits = list(eval.kfold(data, k=folds, by=config.split['by']))
+
+    tasks = [(i, j) for i in range(len(configs)) for j in range(len(splits))]
+    log.info('Evaluating {0} configurations x {1} folds...'.format(len(configs), len(splits)))
+
+    # Everything a task needs is passed along with it
+    # (`ProcessPoolExecutor` only takes an `initializer` from Python 3.7).
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        scores = list(pool.map(_evaluate, [(paths, y, configs[i], splits[j]) for i, j in tasks]))
+
+    results = []
+    for i, conf in enumerate(configs):
+        fold_scores = [s for (ci, _), s in zip(tasks, scores) if ci == i]
+        results.append(dict(conf, folds=fold_scores, mean=_mean_scores(fold_scores)))
+    return results
+
+
+def _evaluate(task):
+    """
+    Evaluates one configuration on one fold, in a worker process.
+    """
+    paths, y, conf, (train, test) = task
+
+    names = conf['features']
+    blocks = [storage.load(paths[name], mmap_mode='r') for name in names]
+
+    # Fit the scalers on the training rows only, so nothing about the test rows leaks into training.
+    train_blocks = [_rows(b, train) for b in blocks]
+    fitted = features.fit_scalers(names, train_blocks)
+    X_train = features.assemble(names, train_blocks, fitted_scalers=fitted)
+    X_test = features.assemble(names, [_rows(b, test) for b in blocks], fitted_scalers=fitted)
+
+    m = models.Model(**conf['params'])
+    m.train(X_train, y[train])
+    return m.evaluate(X_test, y[test], **conf['eval'])
+
+
+def _rows(block, idx):
+    return sparse.csr_matrix(block)[idx] if sparse.issparse(block) else np.asarray(block)[idx]
+
+
+def _product(grid):
+    keys = sorted(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+
+
+def _mean_scores(fold_scores):
+    """
+    Mean of each numeric score across folds.
+    """
+    means = {}
+    for key, val in fold_scores[0].items():
+        if isinstance(val, (int, float, np.number)):
+            means[key] = float(np.mean([s[key] for s in fold_scores]))
+    return means
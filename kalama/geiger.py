@@ -5,52 +5,61 @@ pip install numexpr cython
 pip install git+git://github.com/ftzeng/galaxy
 """
 
+import os
+import pickle
+import hashlib
+import tempfile
 import numpy as np
 from galaxy.cluster.ihac import Hierarchy
-from util.text import Vectorizer, strip_tags
-from config import geiger_path
+from scipy.cluster.hierarchy import linkage, fcluster
+from sklearn.cluster import MiniBatchKMeans
+from util.text import Vectorizer, normalize_html_batch
+from config import geiger_path, geiger_hierarchies_path
 from util.logging import log
-from sklearn.externals import joblib
+from util.registry import registry
 
-def highlights(comments, min_size=5, dist_cutoff=0.5):
+# The available clustering engines (see `highlights`).
+engines = ['ihac', 'kmeans']
+
+def highlights(comments, min_size=5, dist_cutoff=0.5, key=None, engine='ihac'):
     """
     This takes a set of comments,
     clusters them, and then returns representatives from clusters above
     some threshold size.
 
+    Two clustering engines are available:
+
+        - `ihac`: Incremental Hierarchical Agglomerative Clustering. If a `key` is given
+          (e.g. identifying the article the comments are for), the hierarchy is persisted under that key:
+          on later calls it is loaded and only comments which haven't been clustered yet are incorporated.
+          Slow for large sets of comments.
+        - `kmeans`: Mini-batch k-means into many small clusters, followed by hierarchical merging
+          of their centroids only. Suited to large sets of comments (thousands or more).
+
     Args:
         | comments      -- list of Commentables
         | min_size      -- int, minimium cluster size to consider
         | dist_cutoff   -- float, the density at which to snip the hierarchy for clusters
+        | key           -- str, optional key to persist the hierarchy under (`ihac` only)
+        | engine        -- str, the clustering engine, one of `['ihac', 'kmeans']`
 
     Future improvements:
-        - Persist hierarchies instead of rebuilding from scratch (using Hierarchy.load & Hierarchy.save)
         - Tweak min_size and dist_cutoff for the domain.
     """
-    v = joblib.load(geiger_path)
-    vecs = v.vectorize([strip_tags(c.body) for c in comments], train=False)
-    vecs = vecs.toarray()
-
-    log.info('Clustering {0} comments...'.format(vecs.shape[0]))
-
-    # Build the hierarchy.
-    h = Hierarchy(metric='cosine', lower_limit_scale=0.9, upper_limit_scale=1.2)
-    ids = h.fit(vecs)
+    if engine == 'ihac':
+        clusters = _ihac_highlights(comments, dist_cutoff, key)
+    elif engine == 'kmeans':
+        vecs = _vectorize(comments)
+        log.info('Clustering {0} comments...'.format(vecs.shape[0]))
+        clusters = [[comments[i] for i in clus] for clus in kmeans_clusters(vecs, dist_cutoff)]
+    else:
+        raise ValueError('Unknown clustering engine "{0}" (available: {1})'.format(engine, engines))
 
     log.info('Processing resulting clusters...')
 
-    # Build a map of hierarchy ids to comments.
-    map = {ids[i]: c for i, c in enumerate(comments)}
-
-    # Generate the clusters.
-    clusters = h.clusters(distance_threshold=dist_cutoff, with_labels=False)
-
     # Filter to clusters of at least some minimum size.
     clusters = [c for c in clusters if len(c) >= min_size]
 
-    # Get the clusters as comments.
-    clusters = [[map[id] for id in clus] for clus in clusters]
-
     # From each cluster, pick the comment with the highest score.
     highlights = [max(clus, key=lambda c: c.score) for clus in clusters]
 
@@ -61,3 +70,169 @@ def highlights(comments, min_size=5, dist_cutoff=0.5):
     log.info('Done.')
 
     return highlights
+
+
+def _ihac_highlights(comments, dist_cutoff, key):
+    """
+    Clusters comments with a (possibly persisted) IHAC hierarchy.
+    Returns the clusters as lists of comments.
+    """
+    # Hierarchies are only valid for the vector space they were built in.
+    version = registry.digest(geiger_path)
+    h, clustered = load_hierarchy(key, version=version)
+
+    # Only incorporate comments which aren't in the hierarchy yet.
+    new = [c for c in comments if _comment_key(c) not in clustered]
+    if new:
+        vecs = _vectorize(new).toarray()
+
+        log.info('Clustering {0} comments ({1} already clustered)...'.format(vecs.shape[0], len(clustered)))
+
+        ids = h.fit(vecs)
+        for c, id in zip(new, ids):
+            clustered[_comment_key(c)] = int(id)
+
+        if key is not None:
+            save_hierarchy(key, h, clustered, version=version)
+
+    # Build a map of hierarchy ids to comments.
+    map = {clustered[_comment_key(c)]: c for c in comments}
+
+    # Generate the clusters.
+    clusters = h.clusters(distance_threshold=dist_cutoff, with_labels=False)
+
+    # Get the clusters as comments,
+    # ignoring any persisted comments which aren't in this set.
+    return [[map[id] for id in clus if id in map] for clus in clusters]
+
+
+def kmeans_clusters(vecs, dist_cutoff, n_centroids=None, batch_size=1000):
+    """
+    Clusters vectors with mini-batch k-means into many small clusters,
+    then merges them by (average-linkage, cosine) hierarchical clustering of their centroids,
+    snipping the centroid hierarchy at `dist_cutoff`.
+
+    Only the centroids are clustered hierarchically, so this scales to large numbers of vectors.
+
+    Args:
+        | vecs (matrix)         -- n x d sparse matrix or array
+        | dist_cutoff (float)   -- the cosine distance at which to snip the centroid hierarchy
+        | n_centroids (int)     -- number of k-means clusters, defaults to ~4*sqrt(n)
+        | batch_size (int)      -- mini-batch size for k-means
+
+    Returns:
+        | list                  -- list of clusters, as lists of row indices into `vecs`
+    """
+    n = vecs.shape[0]
+    if n < 2:
+        return [list(range(n))] if n else []
+
+    k = min(n, n_centroids or max(2, int(4*np.sqrt(n))))
+    km = MiniBatchKMeans(n_clusters=k, batch_size=min(batch_size, n), random_state=0)
+    labels = km.fit_predict(vecs)
+
+    # Only merge centroids which have members.
+    # Zero-norm centroids (i.e. of empty documents) have no cosine distance, so they're left out.
+    centers = km.cluster_centers_
+    used = np.unique(labels)
+    used = used[np.linalg.norm(centers[used], axis=1) > 0]
+    if len(used) < 2:
+        merged = np.ones(len(used), dtype=int)
+    else:
+        merged = fcluster(linkage(centers[used], method='average', metric='cosine'),
+                          t=dist_cutoff, criterion='distance')
+
+    # Map each comment to its merged cluster (0 for none).
+    to_merged = np.zeros(k, dtype=int)
+    to_merged[used] = merged
+    groups = to_merged[labels]
+
+    order = np.argsort(groups, kind='mergesort')
+    order = order[groups[order] > 0]
+    bounds = np.flatnonzero(np.diff(groups[order])) + 1
+    return [list(idx) for idx in np.split(order, bounds) if len(idx)]
+
+
+def _vectorize(comments):
+    v = registry.get(geiger_path)
+    return v.vectorize(normalize_html_batch([c.body for c in comments]), train=False)
+
+
+def load_hierarchy(key=None, version=''):
+    """
+    Loads the persisted hierarchy for a key, along with the map of
+    comment keys to their ids in the hierarchy.
+    If there isn't one (or no key is given), a new, empty hierarchy is returned.
+
+    Args:
+        | key (str)         -- the key the hierarchy is persisted under
+        | version (str)     -- the version of the vectorizer the hierarchy was built with
+                               (see `registry.digest`); hierarchies of other versions aren't loaded
+    """
+    if key is not None:
+        path = _hierarchy_path(key, version)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                saved = pickle.load(f)
+            return _load_ihac(saved['hierarchy']), saved['clustered']
+
+    h = Hierarchy(metric='cosine', lower_limit_scale=0.9, upper_limit_scale=1.2)
+    return h, {}
+
+
+def save_hierarchy(key, h, clustered, version=''):
+    """
+    Persists a hierarchy and its map of comment keys to hierarchy ids.
+    Both go in a single file, written to a unique temporary file first and then renamed,
+    so concurrent savers (e.g. `warm_cache` and the server's workers) can't leave
+    one's hierarchy paired with another's map, and a failed save can't leave a partial one.
+    """
+    path = _hierarchy_path(key, version)
+    hdir = os.path.dirname(path)
+    if not os.path.exists(hdir):
+        os.makedirs(hdir)
+
+    saved = {'hierarchy': _dump_ihac(h, hdir), 'clustered': clustered}
+    fd, tmp = tempfile.mkstemp(dir=hdir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(saved, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _dump_ihac(h, hdir):
+    """
+    The bytes of a hierarchy as saved by `Hierarchy.save`.
+    """
+    fd, tmp = tempfile.mkstemp(dir=hdir, suffix='.ihac.tmp')
+    os.close(fd)
+    try:
+        h.save(tmp)
+        with open(tmp, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(tmp)
+
+
+def _load_ihac(data):
+    fd, tmp = tempfile.mkstemp(suffix='.ihac')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return Hierarchy.load(tmp)
+    finally:
+        os.remove(tmp)
+
+
+def _hierarchy_path(key, version=''):
+    name = hashlib.md5('{0}:{1}'.format(version, key).encode('utf-8')).hexdigest()
+    return os.path.join(geiger_hierarchies_path, name + '.pkl')
+
+
+def _comment_key(c):
+    # `repr` so ids from different sources (e.g. ints and strings) don't collide.
+    return repr(c.id)
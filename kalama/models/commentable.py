@@ -8,6 +8,7 @@ class Commentable():
         | body      -- flexible
         | body_type -- str
         | author    -- Persona
+        | user_id   -- the source's id for the author, if it has one (e.g. NYT `userID`)
         | score     -- float
         | permalink -- str
     """
@@ -16,6 +17,7 @@ class Commentable():
         self.parent = None
         self.focus = None
         self.author = None
+        self.user_id = None
         self.score = 0.0
         self.body = ''
         self.body_type = 'html'
@@ -1,42 +1,70 @@
+import os
 import sys
+import json
+import time
 import click
 import config
+import numpy as np
 import pandas as pd
-from server import app
+from server import app, cached_comments, crosssample
 from sklearn.externals import joblib
 from kalama.dredd import models, features
 from kalama.dredd.sampling import Sampler
+from kalama.dredd import scoring
+from kalama.dredd import sweep as dredd_sweep
+from kalama.dredd.scoring import score_records
 from util.logging import log
-from util import eval, cryo
-from util.text import Vectorizer, strip_tags, html_decode
+from util import eval, cryo, profiling
+from util.text import Vectorizer, normalize_html_batch
 
 
 @click.group()
-def cli():
-    pass
+@click.option('--trace', default=None, help='Write every profiled step to this JSON lines file.')
+def cli(trace):
+    trace = trace or config.profiling['trace_path']
+    if trace is not None:
+        profiling.start_trace(trace)
 
 
 @cli.command()
 @click.option('--refresh', default=None)
-def dredd(refresh):
+@click.option('--dry-run', is_flag=True, help='Only print which frozen data would be rebuilt.')
+def dredd(refresh, dry_run):
     """
     Evaluate Dredd's performance on a task.
     """
     if refresh is not None:
-        stage = refresh
-        names = [s[0] for s in cryo.stages]
-        i = names.index(stage)
-        cryo.stages[i] = (stage, True)
+        cryo.refresh(refresh)
 
-    data = Sampler().sample()
-    log.info('Data set includes {0} examples...'.format(data.shape[0]))
+    if dry_run:
+        for step in cryo.plan():
+            reason = ' ({0})'.format(step['reason']) if step['reason'] else ''
+            print('[{0}] {1}{2}'.format(step['status'], step['path'], reason))
+        return
+
+    if config.streaming['enabled'] and getattr(models.Model, 'incremental', False):
+        return _dredd_incremental()
+
+    if config.streaming['enabled']:
+        sampler = Sampler()
+        assets = sampler.assets()
+        log.info('Streaming data for {0} assets...'.format(assets.shape[0]))
 
+        log.info('Building features...')
+        X, y = features.featurize_stream(sampler.stream(), assets)
+        log.info('Data set includes {0} examples...'.format(X.shape[0]))
+        indices = None
 
-    log.info('Building features...')
-    X, y = features.featurize(data)
+    else:
+        data = Sampler().sample()
+        log.info('Data set includes {0} examples...'.format(data.shape[0]))
+
+        log.info('Building features...')
+        X, y = features.featurize(data, source=Sampler.sample.fpath())
+        indices = eval.split(data, test_size=config.test_size, by=config.split['by'])
     log.info('Using {0} features...'.format(X.shape[1]))
 
-    X_train, y_train, X_test, y_test = eval.cross_validation_split(X, y, test_size=config.test_size)
+    X_train, y_train, X_test, y_test = eval.cross_validation_split(X, y, test_size=config.test_size, indices=indices)
     log.info('Training on {0} examples...'.format(X_train.shape[0]))
     log.info('Testing on {0} examples...'.format(X_test.shape[0]))
 
@@ -47,12 +75,68 @@ def dredd(refresh):
 
     log.info('Testing model...')
     scores = m.evaluate(X_test, y_test, **config.model['eval'])
-    print(eval.report(config, X_train, X_test, scores))
+    print(eval.report(config, X_train, X_test, scores, blocks=features.block_report))
 
     #for c in m.rank(data_test, X_test).head().iterrows():
         #print('[{0}] {1}'.format(c[1].score, c[1].commentBody))
 
 
+def _dredd_incremental():
+    """
+    Evaluate Dredd out-of-core: features are fit on a sample of the stream,
+    then the model is trained chunk by chunk.
+
+    Evaluation is progressive: each chunk's test rows are scored by the model
+    as trained on the preceding chunks, so memory stays flat.
+    """
+    sampler = Sampler()
+    assets = sampler.assets()
+
+    log.info('Fitting features...')
+    fitted = features.fit_stream(sampler.stream(limit=config.streaming['fit_rows']), assets)
+
+    log.info('Training model...')
+    m = models.Model(**config.model['params'])
+    n_train, y_test, y_pred = 0, [], []
+    batches = features.transform_stream(sampler.stream(), fitted, assets)
+    for X_train, y_train, X_test, y_test_ in eval.split_stream(batches, test_size=config.test_size):
+        if n_train and X_test.shape[0]:
+            y_pred.append(m.predict(X_test))
+            y_test.append(y_test_)
+        if X_train.shape[0]:
+            m.train(X_train, y_train)
+        n_train += X_train.shape[0]
+
+    # The first chunk's test rows are never scored (there's no model yet),
+    # so with a single chunk, or a small `test_size`, there may be nothing to evaluate.
+    if not y_test:
+        raise click.ClickException('No test rows were scored (trained on {0} examples): '
+                                   'stream more than one chunk, or raise `config.test_size`.'.format(n_train))
+
+    y_test, y_pred = np.concatenate(y_test), np.concatenate(y_pred)
+    log.info('Trained on {0} examples, tested on {1}...'.format(n_train, len(y_test)))
+
+    scores = m.metrics(y_test, y_pred, **config.model['eval'])
+    print(eval.report(config, n_train, len(y_test), scores, blocks=features.block_report))
+
+
+@cli.command()
+@click.option('--spec', type=click.File('r'), default=None, help='A JSON sweep spec, instead of `config.sweep`.')
+def sweep(spec):
+    """
+    Evaluate a grid of model params, eval kwargs and feature subsets with k-fold cross-validation.
+    """
+    spec = json.load(spec) if spec is not None else config.sweep
+    data = Sampler().sample()
+    log.info('Data set includes {0} examples...'.format(data.shape[0]))
+
+    results = dredd_sweep.run(data, spec,
+                              folds=spec.get('folds', config.sweep['folds']),
+                              n_jobs=spec.get('n_jobs', config.sweep['n_jobs']),
+                              source=Sampler.sample.fpath())
+    print(eval.sweep_report(config, results, metric=spec.get('metric', config.sweep['metric'])))
+
+
 @cli.command()
 def build_notebook_data():
     """
@@ -64,7 +148,7 @@ def build_notebook_data():
     asset_relevance = features.article.Featurizer().featurize(data)
     data['assetRelevance'] = asset_relevance
 
-    data.to_csv('notebooks/comments.csv', mode='w', encoding='utf-8')
+    data.to_csv(config.notebook_comments_path, mode='w', encoding='utf-8')
 
 
 @cli.command()
@@ -74,18 +158,25 @@ def train(model):
     Trains the specified model on the sampler data.
     """
     if model == 'geiger':
-        data = Sampler().sample()
+        # Trained on chunks of comments, so the full corpus is never held in memory.
+        if config.streaming['enabled']:
+            chunks = (chunk['commentBody'] for chunk in Sampler().stream())
+        else:
+            data = Sampler().sample()
+            size = config.streaming['chunk_size']
+            chunks = (data['commentBody'].values[i:i+size] for i in range(0, len(data), size))
+
         v = Vectorizer()
-        comments = [strip_tags(html_decode(c)) for c in data['commentBody'].to_dict().values()]
-        v.vectorize(comments, train=True)
-        joblib.dump(v, 'geiger_vec.pkl')
+        v.fit_stream(normalize_html_batch(chunk) for chunk in chunks)
+        _dump(v, config.geiger_path)
 
     elif model == 'dredd':
         data = Sampler().sample()
         print('Data set includes {0} examples...'.format(data.shape[0]))
 
+        # Don't use cryo'd features, the featurizers need to be fitted in this process to be saved.
         print('Building features...')
-        X, y = features.featurize(data)
+        X, y = features.featurize(data, cache=False)
         print('Using {0} features...'.format(X.shape[1]))
 
         X_train, y_train, X_test, y_test = eval.cross_validation_split(X, y, test_size=0.0)
@@ -95,15 +186,131 @@ def train(model):
         m = models.Model(**config.model['params'])
         m.train(X_train, y_train)
 
-        joblib.dump(m, 'dredd_model.pkl')
+        # Save the fitted feature stack next to the model.
+        _dump(m, config.dredd_path)
+        _dump(features.fitted(), config.dredd_features_path)
+
+
+@cli.command()
+@click.argument('input', type=click.File('r'))
+@click.argument('output', type=click.File('w'))
+@click.option('--batch-size', default=5000, help='Number of comments to score at a time.')
+@click.option('--id-key', default='commentID', help='The key identifying each comment.')
+def score(input, output, batch_size, id_key):
+    """
+    Score comments with the trained Dredd model.
+
+    Reads a JSONL file of comments (one object per line, with the sampled data's columns),
+    and writes a JSONL file of `{id_key: ..., "score": ...}`. Use `-` for stdin/stdout.
+    """
+    scorer = scoring.load()
+
+    def flush(batch):
+        for record, s in zip(batch, score_records(scorer, batch)):
+            output.write(json.dumps({id_key: record.get(id_key), 'score': float(s)}) + '\n')
+
+    batch = []
+    for line in input:
+        if not line.strip():
+            continue
+        batch.append(json.loads(line))
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+
+@cli.command()
+@click.option('--backend', default=None, help='The storage backend to convert to. Defaults to the configured DataFrame one.')
+def migrate_cryo(backend):
+    """
+    Convert existing freezes to another storage backend,
+    and move freezes from before content-addressed keys to their current keys.
+    """
+    for path in cryo.rekey():
+        log.info('Re-keyed {0}.'.format(path))
+
+    if backend is None:
+        cryo.migrate(config.cryo['backend'])
+        cryo.migrate(config.cryo['other_backend'])
+    else:
+        cryo.migrate(backend)
+
+
+@cli.command()
+@click.option('--gc', is_flag=True, help='Remove freezes not reachable from the current config.')
+@click.option('--evict', is_flag=True, help='Evict the least recently used freezes over the budget.')
+@click.option('--budget-gb', type=float, default=None, help='The budget to evict to, instead of `config.cryo[\'budget_gb\']`.')
+@click.option('--dry-run', is_flag=True, help='Only print what would be removed.')
+def manage_cryo(gc, evict, budget_gb, dry_run):
+    """
+    List frozen data, and optionally remove orphans or evict to the disk budget.
+    """
+    now = time.time()
+    arts = cryo.artifacts()
+    for a in arts:
+        print('{0} {1:<24} {2:>10.1f} MB  age {3:>6.1f}d  accessed {4:>6.1f}d ago  {5}  {6}'.format(
+            '*' if a['current'] else ' ', a['path'], a['size']/1e6,
+            (now - a['created'])/86400, (now - a['accessed'])/86400,
+            a['key'], json.dumps(a['config'], sort_keys=True)))
+    print('{0} freezes, {1:.1f} MB (* = current config)'.format(len(arts), sum(a['size'] for a in arts)/1e6))
+
+    verb = 'Would remove' if dry_run else 'Removed'
+    if gc:
+        for fpath in cryo.collect(dry_run=dry_run):
+            print('{0} {1}'.format(verb, fpath))
+
+    if evict:
+        budget_gb = budget_gb if budget_gb is not None else config.cryo['budget_gb']
+        if budget_gb is None:
+            raise click.UsageError('No budget: set `config.cryo[\'budget_gb\']` or pass --budget-gb.')
+        for fpath in cryo.evict(int(budget_gb * 1e9), dry_run=dry_run):
+            print('{0} {1}'.format(verb, fpath))
+
+
+def _dump(obj, path):
+    """
+    Pickles an object to a path. Writes to a temporary file first,
+    so processes watching the path (see `util.registry`) never load a partial file.
+    It's compressed so joblib writes a single file (rather than one per array).
+    """
+    pdir = os.path.dirname(path)
+    if not os.path.exists(pdir):
+        os.makedirs(pdir)
+    joblib.dump(obj, path + '.tmp', compress=3)
+    os.replace(path + '.tmp', path)
+
+
+@cli.command()
+@click.option('--sources', default='nyt,reddit', help='Comma-separated comment sources.')
+@click.option('--engine', default='ihac', type=click.Choice(['ihac', 'kmeans']))
+def warm_cache(sources, engine):
+    """
+    Precompute Geiger highlights for every article in the cross-sample.
+    """
+    if config.server['cache_path'] is None:
+        log.info('No `cache_path` configured, the server would not see the warmed cache.')
+        return
+
+    sources = sources.split(',')
+    for id in range(len(crosssample)):
+        log.info('Warming article {0}...'.format(id))
+        # Processed here rather than in the server's worker pool, so slow articles can't time out.
+        cached_comments(id, sources, 'geiger', engine, pooled=False)
 
 
 @cli.command()
-def run_server():
+@click.option('--production', is_flag=True, help='Serve requests concurrently, without the debugger.')
+@click.option('--port', default=5001)
+def run_server(production, port):
     """
     Run the demo server.
     """
-    app.run(debug=True, port=5001)
+    if production:
+        app.run(debug=False, threaded=True, port=port)
+    else:
+        app.run(debug=True, port=port)
 
 
 if __name__ == '__main__':
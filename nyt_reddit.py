@@ -82,6 +82,7 @@ def get_nyt_comments(asset_id):
         createDate,
         parentID,
         isReply,
+        userID,
         userDisplayName,
         recommendationCount
     FROM crnr_comment
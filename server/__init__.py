@@ -1,35 +1,48 @@
-import json
-import numpy as np
-import pandas as pd
-from operator import itemgetter
-from flask import Flask, render_template, request
+from concurrent.futures import TimeoutError
+from flask import Flask, render_template, request, jsonify, abort
 
 import config
-from kalama.geiger import highlights
+from kalama import dredd
+from kalama.geiger import highlights, engines
 from util.morph import morph_comments
+from util.registry import registry
+from util import profiling
+from util.profiling import profiled
+from server.store import CrossSample, CommentPool
+from server.cache import LRUCache
+from server.workers import WorkerPool
 
 app = Flask(__name__, static_folder='static', static_url_path='')
 
+# Loaded lazily, and reloaded when their files change.
+crosssample = CrossSample(config.crosssample_path)
+pool = CommentPool(config.notebook_comments_path)
+
+# Processed comments, by article, sources, filter and data version.
+cache = LRUCache(maxsize=config.server['cache_size'], path=config.server['cache_path'],
+                 disk_maxsize=config.server['cache_disk_size'])
+
+# The models each filter's results depend on, so cached results are invalidated when they're retrained.
+filter_models = {
+    'geiger': [config.geiger_path],
+    'dredd_comment': [config.dredd_path, config.dredd_features_path],
+    'dredd_discussion': [config.dredd_path, config.dredd_features_path]
+}
+
+# CPU-heavy filters are run in a process pool (if `config.server['workers']` > 0),
+# so they don't block cheap requests.
+expensive_filters = ['geiger', 'dredd_comment', 'dredd_discussion']
+workers = WorkerPool(config.server['workers'], timeout=config.server['timeout'])
+
 
-data = None
 @app.route('/ludovico/')
 @app.route('/ludovico/<type>')
+@profiled('server.ludovico')
 def ludovico(type='picks'):
     """
     Displays a random comment of the specified type.
     """
-
-    global data
-    data = pd.read_csv('notebooks/comments.csv')
-    # Randomize data.
-    c = data.reindex(np.random.permutation(data.index))
-
-    if type == 'picks':
-        c = c[data.editorsSelection == 1].iloc[0].to_dict()
-    elif type == 'approved':
-        c = c[data.label == 1].iloc[0].to_dict()
-    else:
-        c = c.iloc[0].to_dict()
+    c = pool.random(type)
 
     if c['editorsSelection'] == 1:
         status = 'pick'
@@ -43,25 +56,62 @@ def ludovico(type='picks'):
 
 @app.route('/compare/')
 @app.route('/compare/<int:id>')
+@profiled('server.compare')
 def compare(id=0):
-    with open(config.crosssample_path, 'r') as f:
-        all_comments = json.load(f)
-
-    comments = sorted(all_comments.items(), key=itemgetter(0))[id][1]
+    comments = crosssample.article(id)[1]
     return render_template('compare.html', nyt=comments['nyt'], reddit=comments['reddit'])
 
 
 @app.route('/comments/')
 @app.route('/comments/<int:id>')
+@profiled('server.view_comments')
 def view_comments(id=0):
-    with open(config.crosssample_path, 'r') as f:
-        all_comments = json.load(f)
-
     sources = request.args['sources'].split(',') if 'sources' in request.args else ['nyt', 'reddit']
     filter = request.args['filter'] if 'filter' in request.args else 'rchron'
+    engine = request.args['engine'] if 'engine' in request.args else 'ihac'
+    if engine not in engines:
+        abort(400, 'Unknown engine "{0}", must be one of {1}'.format(engine, engines))
+
+    try:
+        subject, comments = cached_comments(id, sources, filter, engine)
+    except TimeoutError:
+        # The computation carries on, and is cached when it finishes.
+        abort(503)
+    return render_template('comments.html', subject=subject, comments=comments)
+
 
-    # Keep some consistency to the sorting. Heiiiinous
-    raw_comments = sorted(all_comments.items(), key=itemgetter(0))[id][1]
+def cached_comments(id, sources, filter, engine='ihac', pooled=True):
+    """
+    Returns the subject and the processed comments for an article,
+    from the cache if they've been computed for the current cross-sample data.
+
+    With `pooled`, expensive filters are run in the worker pool (and may raise `TimeoutError`),
+    otherwise everything is processed in this process.
+    """
+    url, _ = crosssample.article(id)
+    models = tuple(registry.digest(path) for path in filter_models.get(filter, []))
+    key = (url, tuple(sources), filter, engine, crosssample.version, models)
+
+    with profiling.span('server.cached_comments', filter=filter, engine=engine) as s:
+        result = cache.get(key)
+        s['cache'] = 'miss' if result is None else 'hit'
+        if result is None:
+            if pooled and filter in expensive_filters and config.server['workers'] > 0:
+                result = workers.run(key, process_comments, id, sources, filter, engine,
+                                     callback=lambda result: cache.put(key, result))
+            else:
+                result = process_comments(id, sources, filter, engine)
+                cache.put(key, result)
+        s['rows'] = len(result[1])
+    return result
+
+
+def process_comments(id, sources, filter, engine='ihac'):
+    """
+    Morphs an article's comments from the specified sources into Commentables,
+    then sorts/selects them according to the filter.
+    """
+    url, raw_comments = crosssample.article(id)
     subject = raw_comments['subject']
 
     # Convert from raw comment dicts into Commentable objects.
@@ -74,11 +124,22 @@ def view_comments(id=0):
     elif filter == 'score':
         comments.sort(key=lambda c: c.score, reverse=True)
     elif filter == 'dredd_comment':
-        pass
+        dredd.score(comments, subject=subject)
+        comments.sort(key=lambda c: c.dredd_score, reverse=True)
     elif filter == 'dredd_discussion':
-        pass
+        dredd.score_discussions(comments, subject=subject)
+        comments.sort(key=lambda c: c.dredd_score, reverse=True)
     elif filter == 'geiger':
-        comments = highlights(comments)
+        comments = highlights(comments, key='{0}:{1}'.format(url, ','.join(sorted(sources))), engine=engine)
         comments.sort(key=lambda c: c.score, reverse=True)
 
-    return render_template('comments.html', subject=subject, comments=comments)
+    return subject, comments
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Model registry loads and hits, by model path, comment cache stats,
+    and profiled stats of the routes and pipeline steps.
+    """
+    return jsonify(models=registry.metrics, cache=cache.stats(), profile=profiling.summary())
@@ -0,0 +1,124 @@
+"""
+A size-bounded LRU cache for computed results, with optional on-disk persistence.
+
+With a `path`, every cached value is also pickled to disk, so results survive restarts
+and can be precomputed by another process (see `main.py warm_cache`).
+Entries evicted from memory are still served from disk. The disk is bounded too:
+past `disk_maxsize` entries, the least recently used files are removed
+(including those for keys which can no longer come up, e.g. for old data versions).
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+from sklearn.externals import joblib
+
+
+class LRUCache():
+    def __init__(self, maxsize=128, path=None, disk_maxsize=10000):
+        """
+        Args:
+            | maxsize (int)         -- the maximum number of entries kept in memory
+            | path (str)            -- optional, the directory to persist entries to
+            | disk_maxsize (int)    -- the maximum number of entries kept on disk
+        """
+        self.maxsize = maxsize
+        self.path = path
+        self.disk_maxsize = disk_maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        fpath = self._fpath(key)
+        if fpath is not None and os.path.exists(fpath):
+            value = joblib.load(fpath)
+            _touch(fpath)
+            self._remember(key, value)
+            with self._lock:
+                self.hits += 1
+            return value
+
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self._remember(key, value)
+
+        fpath = self._fpath(key)
+        if fpath is not None:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            tmp = '{0}.{1}.tmp'.format(fpath, os.getpid())
+            joblib.dump(value, tmp, compress=3)
+            os.replace(tmp, fpath)
+            self.prune()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        fpath = self._fpath(key)
+        return fpath is not None and os.path.exists(fpath)
+
+    def prune(self):
+        """
+        Removes the least recently used entries on disk past `disk_maxsize`.
+        """
+        if self.path is None or not os.path.isdir(self.path):
+            return
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.pkl'):
+                fpath = os.path.join(self.path, name)
+                try:
+                    files.append((os.path.getmtime(fpath), fpath))
+                except OSError:
+                    continue
+        files.sort()
+        for _, fpath in files[:max(0, len(files) - self.disk_maxsize)]:
+            try:
+                os.remove(fpath)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _fpath(self, key):
+        if self.path is None:
+            return None
+        name = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name + '.pkl')
+
+
+def _touch(fpath):
+    """
+    Marks a disk entry as recently used (for `prune`).
+    """
+    try:
+        os.utime(fpath, None)
+    except OSError:
+        pass
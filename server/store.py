@@ -0,0 +1,83 @@
+"""
+In-memory data for the server.
+
+Each store loads its file once (lazily, on first access), keeps it in memory
+along with any indices built on it, and reloads it when the file changes.
+"""
+
+import os
+import json
+import threading
+import numpy as np
+import pandas as pd
+from operator import itemgetter
+
+
+class FileStore():
+    """
+    Base class for stores backed by a single file.
+    Subclasses implement `_load(path)`, which builds the store's in-memory data.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Loads the file if it hasn't been loaded yet or has changed since.
+        """
+        mtime = os.path.getmtime(self.path)
+        if mtime != self.version:
+            with self._lock:
+                if mtime != self.version:
+                    self._load(self.path)
+                    self.version = mtime
+
+    def _load(self, path):
+        raise NotImplementedError
+
+
+class CrossSample(FileStore):
+    """
+    The NYT/reddit comments cross-sample collected by `nyt_reddit.py`,
+    as a list of `(url, article)` ordered by url.
+    """
+    def _load(self, path):
+        with open(path, 'r') as f:
+            self.articles = sorted(json.load(f).items(), key=itemgetter(0))
+
+    def article(self, id):
+        self.refresh()
+        return self.articles[id]
+
+    def __len__(self):
+        self.refresh()
+        return len(self.articles)
+
+
+class CommentPool(FileStore):
+    """
+    The NYT sample comments prepared by `main.py build_notebook_data`,
+    pre-split into pools by type (see `types`) so that random picks are O(1).
+    """
+    types = ['picks', 'approved', 'all']
+
+    def _load(self, path):
+        data = pd.read_csv(path)
+        self.data = data
+        self.pools = {
+            'picks': np.flatnonzero((data.editorsSelection == 1).values),
+            'approved': np.flatnonzero((data.label == 1).values),
+            'all': np.arange(len(data))
+        }
+
+    def random(self, type='all'):
+        """
+        Returns a random comment (as a dict) of the given type.
+        Unknown types are treated as 'all'.
+        """
+        self.refresh()
+        pool = self.pools.get(type, self.pools['all'])
+        i = pool[np.random.randint(len(pool))]
+        return self.data.iloc[i].to_dict()
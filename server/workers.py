@@ -0,0 +1,68 @@
+"""
+A bounded process pool for CPU-heavy request processing (e.g. Geiger clustering),
+so that it doesn't block the server's other routes.
+
+Concurrent requests for the same key are coalesced: they wait on a single computation.
+"""
+
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from util.logging import log
+
+
+class WorkerPool():
+    def __init__(self, n_workers, timeout=None):
+        """
+        Args:
+            | n_workers (int)   -- the maximum number of worker processes
+            | timeout (float)   -- seconds a request waits for its result before giving up
+        """
+        self.n_workers = n_workers
+        self.timeout = timeout
+        self._executor = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, f, *args, callback=None):
+        """
+        Runs `f(*args)` in the pool and waits for its result.
+        If a computation for `key` is already running, waits for that one instead.
+
+        Raises `TimeoutError` if the result isn't ready within the timeout.
+        The computation keeps running; `callback` is called with its result when it's done,
+        e.g. to cache it for later requests.
+        """
+        submitted = False
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self.n_workers)
+                future = self._executor.submit(f, *args)
+                self._inflight[key] = future
+                submitted = True
+            else:
+                log.info('Waiting on in-flight computation for {0}...'.format(key))
+
+        # Registered outside the lock: if the future is already done, the callback runs right away.
+        if submitted:
+            future.add_done_callback(lambda fut: self._done(key, fut, callback))
+
+        return future.result(timeout=self.timeout)
+
+    def _done(self, key, future, callback):
+        # The result is handed on (e.g. cached) before the computation stops being in-flight,
+        # so a request arriving in between waits on it rather than starting another one.
+        with self._lock:
+            try:
+                if callback is not None and not future.cancelled() and future.exception() is None:
+                    callback(future.result())
+            finally:
+                self._inflight.pop(key, None)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
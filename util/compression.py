@@ -0,0 +1,81 @@
+"""
+Codecs for compressing frozen data (see `storage.ChunkedBackend`).
+
+`zstd` and `lz4` are used if their packages (`zstandard`, `lz4`) are installed,
+otherwise the standard library's `zlib`, `bz2` and `lzma` are available.
+All of them release the GIL, so buffers can be (de)compressed in parallel on threads.
+"""
+
+import bz2
+import zlib
+import lzma
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class Codec():
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+codecs = {
+    'none': Codec('none', bytes, bytes),
+    'zlib': Codec('zlib', lambda b: zlib.compress(b, 1), zlib.decompress),
+    'bz2': Codec('bz2', lambda b: bz2.compress(b, 1), bz2.decompress),
+    'lzma': Codec('lzma', lambda b: lzma.compress(b, preset=0), lzma.decompress)
+}
+
+if zstandard is not None:
+    codecs['zstd'] = Codec('zstd',
+                           lambda b: zstandard.ZstdCompressor(level=3).compress(b),
+                           lambda b: zstandard.ZstdDecompressor().decompress(b))
+
+if lz4 is not None:
+    codecs['lz4'] = Codec('lz4', lz4.frame.compress, lz4.frame.decompress)
+
+# The fastest available codec is used for 'auto'.
+preference = ['zstd', 'lz4', 'zlib']
+
+
+def get(name='auto'):
+    """
+    Returns the codec by name, or the fastest available one for 'auto'.
+    """
+    if name == 'auto':
+        name = next(n for n in preference if n in codecs)
+    if name not in codecs:
+        raise ValueError('Codec "{0}" is not available (available: {1})'.format(name, sorted(codecs.keys())))
+    return codecs[name]
+
+
+def compress_all(buffers, codec, n_threads=1):
+    """
+    Compresses buffers with the codec across a thread pool, returning them in order.
+    """
+    return _map(codec.compress, buffers, n_threads)
+
+
+def decompress_all(buffers, codec, n_threads=1):
+    """
+    Decompresses buffers with the codec across a thread pool, returning them in order.
+    """
+    return _map(codec.decompress, buffers, n_threads)
+
+
+def _map(f, buffers, n_threads):
+    buffers = list(buffers)
+    if n_threads <= 1 or len(buffers) < 2:
+        return [f(b) for b in buffers]
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        return list(pool.map(f, buffers))
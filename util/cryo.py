@@ -4,24 +4,36 @@ The `cryo` module memoizes large data processing functions.
 It provides the `cryo` decorator which can be used to wrap any function which returns
 data (as a dataframe or a numpy array). The returned data is saved for that particular
 config and reloaded as needed, skipping redundant processing.
+
+Cryo'd functions form a dependency graph (`nodes`): each freeze is keyed by its config,
+its code version and the content of its upstream freezes, and recorded in a `.json` file
+next to it (see `plan` to see what would be rebuilt).
 """
 
 import os
+import sys
 import json
+import time
 import hashlib
+import inspect
 from functools import wraps
 
-import pandas as pd
-from sklearn.externals import joblib
-
 import config
+from util import storage, profiling
 from util.logging import log
 
 stages = [('sampling', False), ('features', False), ('model', False)]
 freezer = []
 
+# Paths frozen during this run (possibly by other processes),
+# which are defrosted even if their stage is being refreshed.
+fresh = set()
+
+# The dependency graph of cryo'd functions, by path.
+nodes = {}
 
-def cryo(stage, path, dep_keys, dtype='dataframe'):
+
+def cryo(stage, path, dep_keys, dtype='dataframe', upstream=(), version=None):
     """
     Decorator for freezing/unfreezing as necessary.
 
@@ -31,74 +43,529 @@ def cryo(stage, path, dep_keys, dtype='dataframe'):
 
     Otherwise, it will run the function then freeze and return the result.
 
-    If any one cryo call requires freshly processing the data, any data later in the
-    pipeline is invalidated, so all subsequent calls will also reprocess the data.
+    Each freeze is keyed by the config values it depends on, the version of the code
+    producing it, and the content digests of the freezes it's computed from (`upstream`).
+    So when a function is re-run, only the functions downstream of it whose input
+    actually changed are re-run too.
+
+    The decorated function also has:
+
+        | fpath()   -- the path its output is (or would be) frozen at for the current config
+        | frozen()  -- whether calling it would defrost rather than run
 
     Args:
         | stage (str)       -- the stage name
         | path (str)        -- the path the frozen data will be stored at
         | dep_keys (list)   -- list of config keys this stage depends on
         | dtype (str)       -- the expected returned dtype: ['dataframe', 'other']
+        | upstream (list)   -- paths of the cryo'd functions whose output this is computed from
+        | version (str)     -- the version of the code producing the data,
+                               defaults to a digest of the function's source (see `source_version`)
     """
     def cryo_dec(f):
+        nodes[path] = {
+            'stage': stage,
+            'path': path,
+            'dep_keys': list(dep_keys),
+            'dtype': dtype,
+            'upstream': list(upstream),
+            'version': version if version is not None else source_version(f)
+        }
+
+        def fpath():
+            return node_path(path)
+
+        def frozen():
+            return _frozen(path)
+
         @wraps(f)
         def decorated(*args, **kwargs):
             global freezer
-            sig = _signature(dep_keys)
-            fpath = _build_path(dtype, path, sig)
+            sig = key(path)
+            fpath = node_path(path, sig)
 
-            freezer.append(fpath)
+            with profiling.span('cryo.{0}'.format(path), stage=stage, sig=sig) as s:
+                if _frozen(path, fpath):
+                    log.info('Defreezing {0} (sig:{1})...'.format(path, sig))
+                    data = _defreeze(fpath)
+                    _touch(fpath)
+                    s['cache'] = 'hit'
 
-            if _preserved(fpath) and not _refresh(stage):
-                log.info('Defreezing {0} (sig:{1})...'.format(path, sig))
-                return _defreeze(fpath)
+                else:
+                    log.info('Running {0}...'.format(path))
+                    data = f(*args, **kwargs)
 
-            else:
-                log.info('Running {0}...'.format(path))
-                data = f(*args, **kwargs)
+                    # The function may have frozen its upstream data as it ran
+                    # (e.g. `Sampler.assets` samples users), which changes its key.
+                    sig = key(path)
+                    fpath = node_path(path, sig)
+
+                    log.info('Freezing {0} (sig:{1})...'.format(path, sig))
+                    _freeze(data, fpath)
+                    _write_meta(path, sig, fpath)
+                    fresh.add(fpath)
+                    s['cache'] = 'miss'
+
+                    if _budget() is not None:
+                        evict(_budget())
+
+                s['rows'] = profiling.num_rows(data)
 
-                log.info('Freezing {0} (sig:{1})...'.format(path, sig))
-                # TO DO this needs to set the refresh flag for the stage.
-                _freeze(data, fpath)
-                return data
+            freezer.append(fpath)
+            return data
+
+        decorated.fpath = fpath
+        decorated.frozen = frozen
         return decorated
     return cryo_dec
 
 
+def key(path):
+    """
+    The content-addressed key of a node for the current config: a hash of its config values,
+    its code version and the digests of its upstream freezes.
+
+    Upstream nodes which aren't frozen yet are represented by their own key instead.
+    """
+    node = nodes[path]
+    return _hash(_key_data(node))
+
+
+def node_path(path, sig=None):
+    """
+    The path a node's output is (or would be) frozen at for the current config.
+    """
+    node = nodes[path]
+    return _build_path(node['dtype'], path, sig or key(path))
+
+
+def digest(path):
+    """
+    The content digest of a node's current freeze, or `None` if it isn't frozen.
+    """
+    fpath = node_path(path)
+    meta = _read_meta(fpath)
+    if meta is not None and 'digest' in meta:
+        return meta['digest']
+    if os.path.exists(fpath):
+        # A freeze without metadata (e.g. written by another process), digest it now.
+        return _write_meta(path, key(path), fpath)['digest']
+    if _rekey(path, fpath):
+        return _read_meta(fpath)['digest']
+    return None
+
+
+def source_version(obj):
+    """
+    A digest of the source code of the module defining a function or class
+    (so that changes to its helpers, e.g. the query builders `Sampler.sample` calls, count too)
+    and of the in-repo modules it uses, directly or not (see `source_modules`),
+    e.g. `util.text` for the `bow` featurizer, plus the object's `version` attribute if it has one.
+    """
+    module = sys.modules.get(obj.__module__)
+    targets = source_modules(module) if module is not None else [obj]
+    srcs = []
+    for target in targets:
+        try:
+            srcs.append(inspect.getsource(target))
+        except (OSError, TypeError):
+            srcs.append(getattr(target, '__name__', '{0}.{1}'.format(obj.__module__, obj.__qualname__)))
+    srcs.append(repr(getattr(obj, 'version', None)))
+    return _hash('\n'.join(srcs))
+
+
+# In-repo modules which don't affect what nodes compute, so they're left out of `source_version`:
+# config data is part of each node's key already, the rest store, log or profile.
+unversioned = ['config', 'util.cryo', 'util.storage', 'util.compression', 'util.logging', 'util.profiling']
+
+def source_modules(module):
+    """
+    A module and the in-repo modules it uses, directly or not, sorted by name.
+    A module uses the modules, classes and functions it has imported.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+    found = {module.__name__: module}
+    todo = [module]
+    while todo:
+        for value in list(vars(todo.pop()).values()):
+            if inspect.ismodule(value):
+                dep = value
+            elif inspect.isclass(value) or inspect.isfunction(value):
+                dep = sys.modules.get(getattr(value, '__module__', None) or '')
+            else:
+                continue
+            if dep is None or dep.__name__ in found or dep.__name__ in unversioned:
+                continue
+            fpath = getattr(dep, '__file__', None)
+            if fpath and os.path.abspath(fpath).startswith(root):
+                found[dep.__name__] = dep
+                todo.append(dep)
+    return [found[name] for name in sorted(found)]
+
+
+def refresh(stage):
+    """
+    Forces the nodes of a stage, and of every later stage, to be re-run.
+    """
+    names = [s[0] for s in stages]
+    i = names.index(stage)
+    stages[i] = (stage, True)
+
+
+def plan(paths=None):
+    """
+    Lists what calling each node (in dependency order) would do with the current config,
+    without running anything.
+
+    Returns:
+        | list      -- of dicts with the node's `path`, `fpath`, `status` ('frozen' or 'rebuild')
+                       and, for rebuilds, the `reason`
+    """
+    order = _toposort(paths or list(nodes.keys()))
+    status = {}
+    steps = []
+    for path in order:
+        node = nodes[path]
+        fpath = node_path(path)
+        stale = [u for u in node['upstream'] if status.get(u) == 'rebuild']
+
+        exists = _preserved(fpath, migrate=False) or _legacy(path) is not None
+        if fpath in fresh or (exists and not _refresh(node['stage']) and not stale):
+            status[path] = 'frozen'
+            reason = None
+        else:
+            status[path] = 'rebuild'
+            if stale:
+                reason = 'upstream may change: {0}'.format(', '.join(stale))
+            elif exists:
+                reason = 'stage {0} is refreshed'.format(node['stage'])
+            else:
+                reason = _changes(path)
+
+        steps.append({'path': path, 'fpath': fpath, 'status': status[path], 'reason': reason})
+    return steps
+
+
+def _frozen(path, fpath=None):
+    fpath = fpath or node_path(path)
+    if fpath in fresh:
+        return True
+    return not _refresh(nodes[path]['stage']) and (_preserved(fpath) or _rekey(path, fpath))
+
+
+def _legacy(path):
+    """
+    The node's freeze from before freezes were keyed by code version and upstream content
+    (i.e. keyed by its config values alone) for the current config, if there is one.
+    """
+    node = nodes[path]
+    root = os.path.join(config.data_root, path, _hash(_config(node['dep_keys'])))
+    for backend in storage.backends.values():
+        fpath = root + backend.ext
+        if backend.dtype == node['dtype'] and os.path.exists(fpath) and _read_meta(fpath) is None:
+            return fpath
+    return None
+
+
+def _rekey(path, fpath):
+    """
+    Moves the node's legacy freeze (see `_legacy`), if any, to its current key,
+    rather than rebuilding it (e.g. re-pulling a random sample, which would differ),
+    converting it to the configured backend if needed.
+    """
+    legacy = _legacy(path)
+    if legacy is None:
+        return False
+
+    log.info('Re-keying {0} as {1}...'.format(legacy, fpath))
+    dest = os.path.splitext(fpath)[0] + os.path.splitext(legacy)[1]
+    storage.replace(legacy, dest)
+    if dest != fpath:
+        storage.migrate(dest, fpath)
+    _write_meta(path, os.path.splitext(os.path.basename(fpath))[0], fpath)
+    return True
+
+
+def rekey():
+    """
+    Moves every legacy freeze for the current config to its current key (see `_rekey`),
+    upstream nodes first, since their digests are part of their downstream nodes' keys.
+
+    Returns:
+        | list      -- the re-keyed nodes' paths
+    """
+    return [path for path in _toposort(list(nodes.keys())) if _rekey(path, node_path(path))]
+
+
+def _key_data(node):
+    upstream = {}
+    for u in node['upstream']:
+        upstream[u] = digest(u) or key(u)
+    return {
+        'config': _config(node['dep_keys']),
+        'version': node['version'],
+        'upstream': upstream
+    }
+
+
+def _changes(path):
+    """
+    Describes what changed since a node's most recent freeze.
+    """
+    metas = [m for m in map(_read_meta, _freezes(path)) if m is not None]
+    if not metas:
+        return 'never frozen'
+
+    last = max(metas, key=lambda m: m.get('created', 0))
+    current = _key_data(nodes[path])
+    changed = [k for k in ['config', 'version'] if last.get(k) != current[k]]
+    changed += ['upstream {0}'.format(u) for u, d in current['upstream'].items()
+                if last.get('upstream', {}).get(u) != d]
+    return 'changed: {0}'.format(', '.join(changed)) if changed else 'not frozen'
+
+
+def _freezes(path):
+    """
+    The paths of every freeze of a node, i.e. `<data_root>/<path>/<key><ext>`.
+    """
+    fdir = os.path.join(config.data_root, path)
+    if not os.path.isdir(fdir):
+        return []
+    exts = [b.ext for b in storage.backends.values()]
+    return [os.path.join(fdir, name) for name in sorted(os.listdir(fdir))
+            if os.path.splitext(name)[1] in exts and _is_key(os.path.splitext(name)[0])]
+
+
+def _is_key(name):
+    return len(name) == 32 and all(c in '0123456789abcdef' for c in name)
+
+
+def artifacts():
+    """
+    Every freeze under `config.data_root`, with its size, age, last access
+    and the config it was computed from.
+
+    Returns:
+        | list      -- of dicts with `path` (the node), `fpath`, `key`, `size` (bytes),
+                       `created` and `accessed` (timestamps), `config` and `current`
+                       (whether it's reachable from the current config)
+    """
+    current = reachable()
+    arts = []
+    if not os.path.isdir(config.data_root):
+        return arts
+
+    for path in sorted(os.listdir(config.data_root)):
+        for fpath in _freezes(path):
+            meta = _read_meta(fpath) or {}
+            created = meta.get('created', os.path.getmtime(fpath))
+            arts.append({
+                'path': path,
+                'fpath': fpath,
+                'key': os.path.splitext(os.path.basename(fpath))[0],
+                'size': meta['size'] if 'size' in meta else storage.size(fpath),
+                'created': created,
+                'accessed': meta.get('accessed', created),
+                'config': meta.get('config'),
+                'current': fpath in current
+            })
+    return arts
+
+
+def reachable():
+    """
+    The paths of the freezes for the current config (and their upstream freezes).
+    """
+    return set(node_path(path) for path in nodes)
+
+
+def collect(dry_run=False):
+    """
+    Removes freezes which aren't reachable from the current config, e.g. for old configs,
+    old code versions or featurizers which were removed, and temporary files left behind by crashes.
+    Temporary files are only removed once they're older than `config.cryo['tmp_grace_hours']`
+    and their writer isn't running anymore (see `storage.abandoned`), since other processes
+    sharing the data root may still be writing them.
+
+    Returns:
+        | list      -- the removed paths
+    """
+    grace = config.cryo['tmp_grace_hours'] * 3600
+    removed = [a['fpath'] for a in artifacts() if not a['current'] and a['fpath'] not in fresh]
+    for path in os.listdir(config.data_root) if os.path.isdir(config.data_root) else []:
+        fdir = os.path.join(config.data_root, path)
+        if os.path.isdir(fdir):
+            removed += [os.path.join(fdir, name) for name in os.listdir(fdir)
+                        if name.startswith(storage.tmp_prefix)
+                        and storage.abandoned(os.path.join(fdir, name), grace)]
+
+    if not dry_run:
+        for fpath in removed:
+            _remove(fpath)
+    return removed
+
+
+def evict(budget, keep=(), dry_run=False):
+    """
+    Removes the least recently used freezes until the total size of the freezes
+    is within the budget. Freezes used during this run (or listed in `keep`) are never evicted.
+
+    Args:
+        | budget (int)  -- the budget in bytes
+
+    Returns:
+        | list          -- the removed paths
+    """
+    arts = sorted(artifacts(), key=lambda a: a['accessed'])
+    keep = set(keep) | fresh | set(freezer)
+    total = sum(a['size'] for a in arts)
+
+    removed = []
+    for a in arts:
+        if total <= budget:
+            break
+        if a['fpath'] in keep:
+            continue
+        removed.append(a['fpath'])
+        total -= a['size']
+
+    if not dry_run:
+        for fpath in removed:
+            log.info('Evicting {0}...'.format(fpath))
+            _remove(fpath)
+    return removed
+
+
+def _budget():
+    budget = config.cryo.get('budget_gb')
+    return None if budget is None else int(budget * 1e9)
+
+
+def _remove(fpath):
+    storage.remove(fpath)
+    mpath = _meta_path(fpath)
+    if os.path.exists(mpath):
+        os.remove(mpath)
+
+
+def _toposort(paths):
+    order = []
+
+    def visit(path):
+        if path in order or path not in nodes:
+            return
+        for u in nodes[path]['upstream']:
+            visit(u)
+        order.append(path)
+
+    for path in paths:
+        visit(path)
+    return order
+
+
+def _meta_path(fpath):
+    return os.path.splitext(fpath)[0] + '.json'
+
+
+def _read_meta(fpath):
+    mpath = _meta_path(fpath)
+    if not os.path.exists(mpath):
+        return None
+    with open(mpath, 'r') as f:
+        return json.load(f)
+
+
+def _write_meta(path, sig, fpath):
+    """
+    Records what a freeze was computed from, and its content digest,
+    which downstream nodes are keyed by.
+    """
+    node = nodes[path]
+    now = time.time()
+    meta = dict(_key_data(node), path=path, stage=node['stage'], key=sig,
+                digest=storage.digest(fpath), size=storage.size(fpath), created=now, accessed=now)
+    _dump_meta(meta, fpath)
+    return meta
+
+
+def _touch(fpath):
+    """
+    Records a freeze's last access, for LRU eviction.
+    """
+    meta = _read_meta(fpath)
+    if meta is not None:
+        meta['accessed'] = time.time()
+        _dump_meta(meta, fpath)
+
+
+def _dump_meta(meta, fpath):
+    mpath = _meta_path(fpath)
+    tmp = storage.temp_path(mpath)
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, sort_keys=True, indent=4)
+    os.replace(tmp, mpath)
+
+
 def _freeze(data, fpath):
     fdir = os.path.dirname(fpath)
     if not os.path.exists(fdir):
         os.makedirs(fdir)
 
-    if isinstance(data, pd.DataFrame):
-        data.to_csv(fpath, mode='w', encoding='utf-8')
-    else:
-        joblib.dump(data, fpath)
+    storage.save(data, fpath)
 
 
-def _defreeze(fpath):
-    ext = os.path.splitext(fpath)[1]
-    if ext == '.csv':
-        return pd.read_csv(fpath, index_col=0, lineterminator='\n')
-    else:
-        return joblib.load(fpath)
+def _defreeze(fpath, **kwargs):
+    kwargs.setdefault('mmap_mode', config.cryo['mmap_mode'])
+    return storage.load(fpath, **kwargs)
 
 
-def _preserved(fpath):
-    return os.path.exists(fpath)
+def _preserved(fpath, migrate=True):
+    """
+    Checks if a freeze exists at the path.
+    Freezes from other backends (e.g. old `.csv` freezes) are migrated to it
+    (unless `migrate` is false).
+    """
+    if os.path.exists(fpath):
+        return True
+
+    root = os.path.splitext(fpath)[0]
+    dtype = storage.backend_for(fpath).dtype
+    for backend in storage.backends.values():
+        if backend.dtype != dtype:
+            continue
+        legacy = root + backend.ext
+        if legacy != fpath and os.path.exists(legacy):
+            if not migrate:
+                return True
+            log.info('Migrating {0} to {1}...'.format(legacy, fpath))
+            storage.migrate(legacy, fpath)
+            return True
+    return False
 
 
 def _build_path(dtype, path, sig):
-    ext = '.csv' if dtype == 'dataframe' else '.pkl'
-    return os.path.join(config.data_root, path, sig) + ext
+    backend = config.cryo['backend'] if dtype == 'dataframe' else config.cryo['other_backend']
+    return os.path.join(config.data_root, path, sig) + storage.backends[backend].ext
 
 
-def _signature(dep_keys):
+def migrate(backend=None):
+    """
+    Converts all freezes under `config.data_root` of the given backend's dtype to that backend
+    (defaults to the configured DataFrame backend).
     """
-    Builds a hash signature for a particular config.
-    THe hash signature is based on a serialized form of the config.
+    dest = storage.backends[backend or config.cryo['backend']]
+    exts = [b.ext for b in storage.backends.values() if b is not dest and b.dtype == dest.dtype]
 
-    The signature is built from the config values at the specified `dep_keys`.
+    srcs = [a['fpath'] for a in artifacts() if os.path.splitext(a['fpath'])[1] in exts]
+
+    for src in srcs:
+        log.info('Migrating {0}...'.format(src))
+        storage.migrate(src, os.path.splitext(src)[0] + dest.ext)
+
+
+def _config(dep_keys):
+    """
+    The config values at the specified `dep_keys` (period-delimited key paths).
     """
     conf = {}
     for key in dep_keys:
@@ -107,23 +574,18 @@ def _signature(dep_keys):
         for subkey in keys[1:]:
             d = d[subkey]
         conf[key] = d
-    conf = json.dumps(conf, sort_keys=True).encode('utf-8')
-    return hashlib.md5(conf).hexdigest()
+    return conf
+
+
+def _hash(obj):
+    data = obj if isinstance(obj, str) else json.dumps(obj, sort_keys=True)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
 
 
 def _refresh(stage):
     """
-    Checks if the stage previous to the passed one was refreshed.
-    If true, refresh this stage as well.
+    Checks if this stage, or any stage before it, is being refreshed.
     """
     names = [s[0] for s in stages]
     i = names.index(stage)
-
-    # If the first stage, just return its own value.
-    if i == 0:
-        return stages[i][1]
-
-    # Otherwise, return the value of the previous stage.
-    elif stages[i][1] or stages[i-1][1]:
-        stages[i] = (stage, True)
-        return True
+    return any(refreshed for _, refreshed in stages[:i+1])
@@ -0,0 +1,86 @@
+"""
+Batched row-wise distances.
+
+Computes the distance between each row of `X` and a row of `Y` selected by an index array,
+i.e. `d(X[i], Y[index[i]])` for every `i`, using chunked matrix operations
+rather than one `scipy.spatial.distance` call per row.
+
+Works with both scipy sparse matrices and dense arrays.
+"""
+
+import numpy as np
+from scipy import sparse
+
+metrics = ['cosine', 'euclidean', 'sqeuclidean', 'cityblock']
+
+
+def rowwise(X, Y, index, metric='cosine', chunk_size=50000):
+    """
+    Distances between the rows of `X` and the rows of `Y` at `index`.
+
+    For the cosine metric, a pair in which either row has zero norm
+    has no defined angle; it is given a distance of 1 (i.e. a similarity of 0).
+
+    Args:
+        | X (matrix)        -- n x d sparse matrix or array
+        | Y (matrix)        -- m x d sparse matrix or array
+        | index (ndarray)   -- n ints, the row in `Y` to pair with each row of `X`
+        | metric (str)      -- one of `metrics`
+        | chunk_size (int)  -- number of rows processed per batch
+
+    Returns:
+        | ndarray           -- n distances
+    """
+    if metric not in metrics:
+        raise ValueError('Unsupported metric "{0}", expected one of {1}'.format(metric, metrics))
+
+    index = np.asarray(index)
+    n = X.shape[0]
+    if len(index) != n:
+        raise ValueError('Expected {0} indices, got {1}'.format(n, len(index)))
+
+    if sparse.issparse(X): X = X.tocsr()
+    if sparse.issparse(Y): Y = Y.tocsr()
+
+    dists = np.empty(n, dtype=float)
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        Xc = X[start:end]
+        Yc = Y[index[start:end]]
+        dists[start:end] = _distances(Xc, Yc, metric)
+    return dists
+
+
+def _distances(A, B, metric):
+    if metric == 'cosine':
+        norms = np.sqrt(_rowdot(A, A) * _rowdot(B, B))
+        zero = norms == 0
+        sims = _rowdot(A, B)
+        sims[zero] = 0
+        sims[~zero] /= norms[~zero]
+        # Clip floating point overshoot.
+        return 1 - np.clip(sims, -1, 1)
+
+    diff = A - B
+    if metric == 'cityblock':
+        return _rowsum(abs(diff))
+
+    sq = np.maximum(_rowdot(diff, diff), 0)
+    if metric == 'sqeuclidean':
+        return sq
+    return np.sqrt(sq)
+
+
+def _rowdot(A, B):
+    """
+    Row-wise dot products of two equally-shaped matrices.
+    """
+    if sparse.issparse(A) or sparse.issparse(B):
+        prod = A.multiply(B) if sparse.issparse(A) else B.multiply(A)
+        return _rowsum(prod)
+    A, B = np.asarray(A, dtype=float), np.asarray(B, dtype=float)
+    return np.einsum('ij,ij->i', A, B)
+
+
+def _rowsum(M):
+    return np.asarray(M.sum(axis=1), dtype=float).ravel()
@@ -1,41 +1,174 @@
 import json
 from util.cryo import freezer
+from util import profiling
 import numpy as np
 
 
-def cross_validation_split(features, labels, test_size=0.4):
+def cross_validation_split(features, labels, test_size=0.4, indices=None):
     """
-    Splits a DataFrame into a random training and testing set.
+    Splits features and labels into a training and testing set.
+
+    Rather than shuffling the whole data set and then slicing it,
+    each set is taken once by index (see `split_indices`), so the data is only copied once.
+    Works with arrays, memory-mapped arrays and sparse matrices.
 
     Args:
         | test_size (float)     -- what portion of the data to use for testing
+        | indices (tuple)       -- optional, `(train, test)` index arrays to split by
+                                   (e.g. from `group_split` or `time_split`), instead of a random split
+    """
+    n = features.shape[0]
+    assert n == len(labels)
+    train, test = indices if indices is not None else split_indices(n, test_size)
+
+    return features[train], labels[train], features[test], labels[test]
+
+
+def split_indices(n, test_size=0.4, seed=None):
+    """
+    Random split of `n` rows into `(train, test)` index arrays.
+    The indices are sorted, so rows are read in order.
+    """
+    rs = np.random.RandomState(seed)
+    shuffled = rs.permutation(n)
+    split = (int)(test_size * n)
+    return np.sort(shuffled[split:]), np.sort(shuffled[:split])
+
+
+def group_split(groups, test_size=0.4, seed=None):
+    """
+    Random split of rows by group (e.g. `userID` or `assetID`), so that every group
+    falls entirely in either the training or the testing set.
+    Roughly `test_size` of the groups (not rows) are used for testing.
+
+    Args:
+        | groups (array)        -- the group of each row
+
+    Returns:
+        | tuple                 -- `(train, test)` sorted index arrays
+    """
+    rs = np.random.RandomState(seed)
+    uniques, inverse = np.unique(np.asarray(groups), return_inverse=True)
+    test_groups = rs.rand(len(uniques)) < test_size
+    test = test_groups[inverse]
+    return np.flatnonzero(~test), np.flatnonzero(test)
+
+
+def time_split(dates, test_size=0.4):
+    """
+    Split of rows by time: the latest `test_size` of rows are used for testing.
+
+    Args:
+        | dates (array)         -- the date of each row (e.g. `createDate`)
+
+    Returns:
+        | tuple                 -- `(train, test)` sorted index arrays
+    """
+    n = len(dates)
+    order = np.argsort(np.asarray(dates), kind='mergesort')
+    split = n - (int)(test_size * n)
+    return np.sort(order[:split]), np.sort(order[split:])
+
+
+def kfold(data, k=5, by='random', seed=None):
+    """
+    Yields `(train, test)` sorted index arrays for each of `k` folds over the rows of a DataFrame.
+
+    Args:
+        | by (str)              -- `random`, or a column to split by group (e.g. `userID`, `assetID`),
+                                   so every group falls in a single fold,
+                                   or `createDate`, so each fold is a contiguous span of time.
     """
+    if by != 'random' and by not in data:
+        raise KeyError('Can\'t split by "{0}", the data has no such column'.format(by))
 
-    # Shuffle the data.
-    assert len(features) == len(labels)
-    shuffled = np.random.permutation(len(features))
-    labels   = labels[shuffled]
-    features = features[shuffled]
+    rs = np.random.RandomState(seed)
+    if by == 'random':
+        folds = rs.permutation(len(data)) % k
+    elif by == 'createDate':
+        order = np.argsort(data['createDate'].values, kind='mergesort')
+        folds = np.empty(len(data), dtype=int)
+        folds[order] = np.arange(len(data)) * k // max(len(data), 1)
+    else:
+        uniques, inverse = np.unique(data[by].values, return_inverse=True)
+        folds = rs.permutation(len(uniques))[inverse] % k
 
-    # Split the data.
-    split = (int)(test_size * len(features))
-    feat_test    = features[:split]
-    feat_train   = features[split:]
-    labels_test  = labels[:split]
-    labels_train = labels[split:]
+    for i in range(k):
+        test = folds == i
+        yield np.flatnonzero(~test), np.flatnonzero(test)
 
-    return feat_train, labels_train, feat_test, labels_test
 
+def split(data, test_size=0.4, by='random'):
+    """
+    `(train, test)` index arrays for the rows of a DataFrame.
 
-def report(config, X_train, X_test, scores):
+    Args:
+        | by (str)              -- `random`, `createDate` (a time split), or a column
+                                   to split by group (e.g. `userID`, `assetID`)
+    """
+    if by == 'random':
+        return split_indices(len(data), test_size)
+    elif by == 'createDate':
+        return time_split(data['createDate'].values, test_size)
+    else:
+        return group_split(data[by].values, test_size)
+
+
+def split_stream(batches, test_size=0.4, seed=None):
+    """
+    Randomly splits each `(X, y)` batch of a stream into training and testing sets,
+    yielding `(X_train, y_train, X_test, y_test)` per batch.
+
+    Args:
+        | batches (iterable)    -- `(X, y)` tuples
+        | test_size (float)     -- what portion of the data to use for testing
+        | seed (int)            -- optional, random seed
+    """
+    rs = np.random.RandomState(seed)
+    for X, y in batches:
+        test = rs.rand(X.shape[0]) < test_size
+        train = ~test
+        yield X[train], y[train], X[test], y[test]
+
+
+def report(config, X_train, X_test, scores, blocks=None):
     """
     Output a simple evaluation report.
+
+    Args:
+        | X_train, X_test   -- the training and testing data (or just their numbers of rows)
+        | blocks (dict)     -- optional, stats for each featurizer's block of features
+
+    The report includes the profiled stats of each pipeline step (see `util.profiling`).
     """
     out_dict = {k: getattr(config, k) for k in dir(config) if k[0] != '_'}
     out_dict['_scores'] = scores
     out_dict['_data'] = {
-            'num_train': X_train.shape[0],
-            'num_test':  X_test.shape[0]
+            'num_train': _num_rows(X_train),
+            'num_test':  _num_rows(X_test)
     }
     out_dict['_freezer'] = freezer
+    out_dict['_profile'] = profiling.summary()
+    if blocks is not None:
+        out_dict['_features'] = blocks
     return json.dumps(out_dict, sort_keys=True, indent=4)
+
+
+def sweep_report(config, results, metric=None):
+    """
+    Output a consolidated report for a sweep (see `kalama.dredd.sweep`),
+    with the results ordered by their mean `metric`, best first.
+
+    Args:
+        | metric (str)      -- the score to rank by (higher is better), defaults to `config.sweep['metric']`
+    """
+    metric = metric or config.sweep['metric']
+    out_dict = {k: getattr(config, k) for k in dir(config) if k[0] != '_'}
+    out_dict['_freezer'] = freezer
+    out_dict['_profile'] = profiling.summary()
+    out_dict['_sweep'] = sorted(results, key=lambda r: r['mean'].get(metric, float('-inf')), reverse=True)
+    return json.dumps(out_dict, sort_keys=True, indent=4)
+
+
+def _num_rows(X):
+    return X if isinstance(X, int) else X.shape[0]
@@ -18,6 +18,7 @@ def morph_comments(comments, source):
             'createDate': 'created_at',
             'commentID': 'id',
             'userDisplayName': 'author',
+            'userID': 'user_id',
             'recommendationCount': 'score'
         },
         'reddit': {
@@ -32,6 +33,11 @@ def morph_comments(comments, source):
     return normalize_scores(morphed)
 
 
+# Keys which older raw comments may lack (e.g. cross-samples collected before `userID` was),
+# these keep the Commentable's default.
+optional = ['userID']
+
+
 def morph(comment, map, reply_key='replies'):
     """
     Morph a single raw comment into a Commentable.
@@ -39,6 +45,8 @@ def morph(comment, map, reply_key='replies'):
     c = Commentable()
 
     for k, v in map.items():
+        if k not in comment and k in optional:
+            continue
         val = comment[k]
         if v == 'created_at':
             raw = comment[k]
@@ -66,7 +74,7 @@ def normalize_scores(comments):
     """
 
     # Flatten threads.
-    flat = [c for c in _flatten(comments)]
+    flat = [c for c in flatten(comments)]
 
     best = max(flat, key=lambda c: c.score).score
     for c in flat:
@@ -74,8 +82,11 @@ def normalize_scores(comments):
     return comments
 
 
-def _flatten(comments):
+def flatten(comments):
+    """
+    Yields every Commentable in a list of threads (replies first).
+    """
     for c in comments:
-        for r in _flatten(c.replies):
+        for r in flatten(c.replies):
             yield r
         yield c
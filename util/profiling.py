@@ -0,0 +1,170 @@
+"""
+Instrumentation for the pipeline stages (sampling, features, model) and the server.
+
+Instrumented code runs in a `span`, which records its wall time, CPU time,
+the change in the process's RSS over the span, the process's RSS high-water mark
+(which only ever grows, so it isn't attributable to the span), the number of rows
+it processed and, for cached steps, whether it was a cache hit or miss:
+
+    with span('features.user') as s:
+        X = f.featurize(data)
+        s['rows'] = X.shape[0]
+
+or, for whole functions:
+
+    @profiled('model.train')
+    def train(self, X_train, y_train):
+        ...
+
+Spans are aggregated by name (see `summary`), which goes into `eval.report`.
+With `start_trace`, every span is also written to a JSON lines trace file,
+so that runs can be diffed.
+"""
+
+import os
+import time
+import json
+import resource
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+import config
+
+# Aggregated stats, by span name.
+stats = {}
+
+_lock = threading.Lock()
+_trace = None
+
+
+@contextmanager
+def span(name, **info):
+    """
+    Records a block of code as a span named `name`.
+
+    The yielded dict can be updated with `rows` (number of rows processed)
+    and `cache` ('hit' or 'miss'), as well as any other info for the trace.
+    """
+    record = dict(info, name=name)
+    if not config.profiling['enabled']:
+        yield record
+        return
+
+    wall, cpu, rss = time.time(), time.process_time(), current_rss()
+    try:
+        yield record
+    finally:
+        record['wall'] = time.time() - wall
+        record['cpu'] = time.process_time() - cpu
+        record['rss_delta'] = current_rss() - rss
+        record['max_rss'] = max_rss()
+        _record(record)
+
+
+def profiled(name, rows=None):
+    """
+    Decorator recording each call of a function as a span.
+
+    Args:
+        | name (str)        -- the span name
+        | rows (func)       -- optional, computes the number of rows processed from the call's
+                               positional arguments (e.g. `lambda self, X, y: X.shape[0]`)
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with span(name) as s:
+                if rows is not None:
+                    s['rows'] = rows(*args)
+                return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def num_rows(data):
+    """
+    The number of rows of a DataFrame, array or matrix (or `None` if it has none).
+    """
+    if hasattr(data, 'shape') and len(data.shape):
+        return int(data.shape[0])
+    try:
+        return len(data)
+    except TypeError:
+        return None
+
+
+def max_rss():
+    """
+    The RSS high-water mark of this process so far, in MB.
+    """
+    # `ru_maxrss` is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3
+
+
+def current_rss():
+    """
+    The current resident set size of this process, in MB
+    (falls back to the high-water mark where `/proc` isn't available).
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return max_rss()
+    return pages*resource.getpagesize()/1e6
+
+
+def summary():
+    """
+    Aggregated stats for each span name: number of calls, total wall and CPU time,
+    the largest RSS growth over a single call, the process's RSS high-water mark,
+    total rows and cache hits/misses.
+    """
+    with _lock:
+        return {name: dict(s) for name, s in stats.items()}
+
+
+def reset():
+    with _lock:
+        stats.clear()
+
+
+def start_trace(path):
+    """
+    Writes every span recorded from now on to a JSON lines file at `path`.
+    """
+    global _trace
+    stop_trace()
+    fdir = os.path.dirname(path)
+    if fdir and not os.path.exists(fdir):
+        os.makedirs(fdir)
+    _trace = open(path, 'w')
+
+
+def stop_trace():
+    global _trace
+    if _trace is not None:
+        _trace.close()
+        _trace = None
+
+
+def _record(record):
+    with _lock:
+        s = stats.setdefault(record['name'], {
+            'calls': 0, 'wall': 0., 'cpu': 0., 'rss_delta': 0., 'max_rss': 0., 'rows': 0, 'hits': 0, 'misses': 0
+        })
+        s['calls'] += 1
+        s['wall'] += record['wall']
+        s['cpu'] += record['cpu']
+        s['rss_delta'] = max(s['rss_delta'], record['rss_delta'])
+        s['max_rss'] = max(s['max_rss'], record['max_rss'])
+        s['rows'] += record.get('rows') or 0
+        if record.get('cache') == 'hit':
+            s['hits'] += 1
+        elif record.get('cache') == 'miss':
+            s['misses'] += 1
+
+        if _trace is not None:
+            _trace.write(json.dumps(record, sort_keys=True, default=str) + '\n')
+            _trace.flush()
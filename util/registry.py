@@ -0,0 +1,86 @@
+"""
+A process-wide registry of pickled models (e.g. Geiger's vectorizer, Dredd's model).
+
+Each model is loaded once per process and then served from memory.
+Files are checked on access: if a file's mtime changes, its content hash is compared
+and the model is reloaded only if the content actually changed.
+"""
+
+import os
+import hashlib
+import threading
+
+from sklearn.externals import joblib
+
+from util.logging import log
+
+
+class Registry():
+    def __init__(self):
+        self._models = {}
+        self._digests = {}
+        self._lock = threading.Lock()
+        self.metrics = {}
+
+    def get(self, path):
+        """
+        Returns the model pickled at `path`, loading (or reloading) it if necessary.
+        """
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            stats = self.metrics.setdefault(path, {'loads': 0, 'hits': 0, 'reloads': 0})
+            entry = self._models.get(path)
+
+            if entry is not None:
+                if entry['mtime'] == mtime:
+                    stats['hits'] += 1
+                    return entry['model']
+
+                # The file was touched, see if it actually changed.
+                digest = _digest(path)
+                if entry['digest'] == digest:
+                    entry['mtime'] = mtime
+                    stats['hits'] += 1
+                    return entry['model']
+
+                log.info('Reloading {0}...'.format(path))
+                stats['reloads'] += 1
+            else:
+                log.info('Loading {0}...'.format(path))
+                digest = _digest(path)
+
+            model = joblib.load(path)
+            self._models[path] = {'model': model, 'mtime': mtime, 'digest': digest}
+            stats['loads'] += 1
+            return model
+
+    def digest(self, path):
+        """
+        The content hash of the model file at `path` (without loading the model),
+        e.g. to key data derived from the model, so it's invalidated when the model is retrained.
+        Hashes are only recomputed when the file's mtime changes.
+        """
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            entry = self._models.get(path) or self._digests.get(path)
+            if entry is not None and entry['mtime'] == mtime:
+                return entry['digest']
+        digest = _digest(path)
+        with self._lock:
+            self._digests[path] = {'mtime': mtime, 'digest': digest}
+        return digest
+
+    def clear(self):
+        with self._lock:
+            self._models = {}
+
+
+def _digest(path, block_size=2**20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+registry = Registry()
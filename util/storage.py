@@ -0,0 +1,542 @@
+"""
+Storage backends for `cryo`.
+
+A backend knows how to save data to and load data from a path with its extension:
+
+- `csv`: DataFrames as CSV (the original format, kept for reading old freezes)
+- `columnar`: DataFrames as a directory of per-column `.npy` files plus a `manifest.json`.
+  This preserves dtypes, supports loading only selected columns,
+  and loading columns as memory-mapped arrays (see `ColumnarBackend.load_columns`).
+- `chunked`: DataFrames as chunks of rows, each column of each chunk compressed independently,
+  so freezes are small, (de)compressed in parallel and chunks can be loaded on their own.
+- `arrays`: NumPy arrays and scipy sparse matrices as a directory of raw buffers
+  (e.g. `data`/`indices`/`indptr`) plus a `manifest.json`, which can be memory-mapped.
+  Other objects are pickled inside the directory.
+- `pickle`: anything, via joblib (the original format for non-DataFrames)
+
+The backend for a path is picked by its extension (see `backend_for`).
+"""
+
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.externals import joblib
+
+import config
+from util import compression
+
+# Prefix of temporary paths (see `save`), e.g. left behind by crashed writes.
+tmp_prefix = '.tmp-'
+
+
+class CSVBackend():
+    ext = '.csv'
+    dtype = 'dataframe'
+
+    def save(self, data, fpath):
+        data.to_csv(fpath, mode='w', encoding='utf-8')
+
+    def load(self, fpath, columns=None, mmap_mode=None):
+        data = pd.read_csv(fpath, index_col=0, lineterminator='\n')
+        return data if columns is None else data[columns]
+
+
+class ColumnarBackend():
+    """
+    Stores each column of a DataFrame as its own `.npy` file.
+
+    Numeric, boolean and datetime columns are saved as-is.
+    String columns are saved as a UTF-8 byte buffer plus an array of offsets
+    (and a null mask), so they can be loaded without unpickling.
+    Any other column is pickled.
+    """
+    ext = '.cols'
+    dtype = 'dataframe'
+    version = 1
+
+    def save(self, data, fpath):
+        if not os.path.exists(fpath):
+            os.makedirs(fpath)
+
+        manifest = {
+            'format': 'columnar',
+            'version': self.version,
+            'rows': len(data),
+            'index': self._save_column(data.index.values, fpath, 'index'),
+            'columns': []
+        }
+        for i, name in enumerate(data.columns):
+            col = self._save_column(data[name].values, fpath, 'c{0}'.format(i))
+            col['name'] = name
+            manifest['columns'].append(col)
+
+        with open(os.path.join(fpath, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def load(self, fpath, columns=None, mmap_mode=None):
+        """
+        Args:
+            | fpath (str)       -- the freeze's path
+            | columns (list)    -- optional, only load these columns, in this order
+            | mmap_mode (str)   -- ignored, pandas copies the columns into its own blocks when
+                                   building the frame, so mapping them wouldn't save memory
+                                   (use `load_columns` for memory-mapped arrays)
+        """
+        manifest = self.manifest(fpath)
+        arrays = self.load_columns(fpath, columns=columns)
+        index = self._load_column(manifest['index'], fpath, None)
+        return pd.DataFrame(arrays, index=index, columns=list(arrays.keys()))
+
+    def load_columns(self, fpath, columns=None, mmap_mode=None):
+        """
+        Loads columns as a dict of arrays, in the order of `columns` (or else the stored order).
+        With `mmap_mode`, numeric columns are returned as memory-mapped arrays (no copy).
+        """
+        manifest = self.manifest(fpath)
+        cols = manifest['columns']
+        if columns is not None:
+            by_name = {c['name']: c for c in cols}
+            missing = set(columns) - set(by_name)
+            if missing:
+                raise KeyError('Columns not in freeze: {0}'.format(sorted(missing)))
+            cols = [by_name[name] for name in columns]
+
+        arrays = OrderedDict()
+        for col in cols:
+            arrays[col['name']] = self._load_column(col, fpath, mmap_mode)
+        return arrays
+
+    def manifest(self, fpath):
+        with open(os.path.join(fpath, 'manifest.json'), 'r') as f:
+            return json.load(f)
+
+    def _save_column(self, values, fpath, key):
+        col = {'dtype': str(values.dtype), 'file': key}
+        if values.dtype.kind in 'biufcmM':
+            col['kind'] = 'array'
+            np.save(os.path.join(fpath, key + '.npy'), values)
+
+        elif _is_strings(values):
+            col['kind'] = 'string'
+            nulls = pd.isnull(values)
+            encoded = [b'' if null else v.encode('utf-8') for v, null in zip(values, nulls)]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(e) for e in encoded], out=offsets[1:])
+            np.save(os.path.join(fpath, key + '.bytes.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+            np.save(os.path.join(fpath, key + '.offsets.npy'), offsets)
+            np.save(os.path.join(fpath, key + '.nulls.npy'), nulls)
+
+        else:
+            col['kind'] = 'pickle'
+            joblib.dump(values, os.path.join(fpath, key + '.pkl'))
+
+        return col
+
+    def _load_column(self, col, fpath, mmap_mode):
+        key = os.path.join(fpath, col['file'])
+        if col['kind'] == 'array':
+            return np.load(key + '.npy', mmap_mode=mmap_mode)
+
+        elif col['kind'] == 'string':
+            buf = np.load(key + '.bytes.npy', mmap_mode=mmap_mode).tobytes()
+            offsets = np.load(key + '.offsets.npy')
+            nulls = np.load(key + '.nulls.npy')
+            values = np.empty(len(nulls), dtype=object)
+            for i, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+                values[i] = None if nulls[i] else buf[start:end].decode('utf-8')
+            return values
+
+        else:
+            return joblib.load(key + '.pkl')
+
+
+class ChunkedBackend():
+    """
+    Stores a DataFrame in chunks of `config.cryo['chunk_rows']` rows. Each column of each chunk
+    is compressed on its own (with `config.cryo['codec']`, see `util.compression`)
+    and appended to a single `data.bin`, with their offsets in a `manifest.json`.
+
+    Buffers are (de)compressed on a thread pool of `config.cryo['io_threads']`,
+    and single chunks (or columns) can be loaded without reading the rest.
+
+    Numeric, boolean and datetime columns are saved as raw buffers.
+    String columns are dictionary-encoded within each chunk (codes, plus the unique strings
+    as a UTF-8 buffer and offsets), so repeated text (e.g. `assetBody`) is stored once per chunk.
+    Any other column is pickled.
+    """
+    ext = '.chk'
+    dtype = 'dataframe'
+    version = 1
+
+    def save(self, data, fpath):
+        if not os.path.exists(fpath):
+            os.makedirs(fpath)
+
+        codec = compression.get(config.cryo['codec'])
+        chunk_rows = config.cryo['chunk_rows']
+        columns = [data.index.values] + [data[name].values for name in data.columns]
+        kinds = [self._kind(values) for values in columns]
+
+        manifest = {
+            'format': 'chunked',
+            'version': self.version,
+            'codec': codec.name,
+            'rows': len(data),
+            'index': {'kind': kinds[0], 'dtype': str(columns[0].dtype)},
+            'columns': [{'name': name, 'kind': kind, 'dtype': str(values.dtype)}
+                        for name, kind, values in zip(data.columns, kinds[1:], columns[1:])],
+            'chunks': []
+        }
+
+        offset = 0
+        with open(os.path.join(fpath, 'data.bin'), 'wb') as f:
+            for start in range(0, len(data), chunk_rows):
+                encoded = [self._encode(values[start:start+chunk_rows], kind)
+                           for values, kind in zip(columns, kinds)]
+                buffers = compression.compress_all([b for parts in encoded for b in parts],
+                                                   codec, config.cryo['io_threads'])
+
+                # Each column's [offset, length] per buffer, index first.
+                spans, buffers = [], iter(buffers)
+                for parts in encoded:
+                    col_spans = []
+                    for _ in parts:
+                        buf = next(buffers)
+                        f.write(buf)
+                        col_spans.append([offset, len(buf)])
+                        offset += len(buf)
+                    spans.append(col_spans)
+
+                manifest['chunks'].append({
+                    'rows': min(chunk_rows, len(data) - start),
+                    'index': spans[0],
+                    'columns': spans[1:]
+                })
+
+        with open(os.path.join(fpath, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def load(self, fpath, columns=None, mmap_mode=None):
+        """
+        Args:
+            | fpath (str)       -- the freeze's path
+            | columns (list)    -- optional, only load these columns
+            | mmap_mode (str)   -- ignored, compressed chunks can't be memory-mapped
+        """
+        manifest = self.manifest(fpath)
+        return self._load(fpath, manifest, range(len(manifest['chunks'])), columns)
+
+    def load_chunk(self, fpath, i, columns=None):
+        """
+        Loads only the `i`th chunk of rows.
+        """
+        return self._load(fpath, self.manifest(fpath), [i], columns)
+
+    def n_chunks(self, fpath):
+        return len(self.manifest(fpath)['chunks'])
+
+    def manifest(self, fpath):
+        with open(os.path.join(fpath, 'manifest.json'), 'r') as f:
+            return json.load(f)
+
+    def _load(self, fpath, manifest, chunks, columns):
+        cols = list(enumerate(manifest['columns']))
+        if columns is not None:
+            by_name = {c['name']: (j, c) for j, c in cols}
+            missing = set(columns) - set(by_name)
+            if missing:
+                raise KeyError('Columns not in freeze: {0}'.format(sorted(missing)))
+            cols = [by_name[name] for name in columns]
+
+        # The buffers to read, as (chunk, column (None for the index), spans).
+        wanted = []
+        for i in chunks:
+            chunk = manifest['chunks'][i]
+            wanted.append((i, None, chunk['index']))
+            wanted += [(i, j, chunk['columns'][j]) for j, _ in cols]
+
+        raw = []
+        with open(os.path.join(fpath, 'data.bin'), 'rb') as f:
+            for _, _, spans in wanted:
+                for offset, length in spans:
+                    f.seek(offset)
+                    raw.append(f.read(length))
+        buffers = iter(compression.decompress_all(raw, compression.get(manifest['codec']),
+                                                  config.cryo['io_threads']))
+
+        parts = {}
+        for i, j, spans in wanted:
+            col = manifest['index'] if j is None else manifest['columns'][j]
+            parts.setdefault(j, []).append(self._decode([next(buffers) for _ in spans], col))
+
+        index = self._concat(parts.get(None, []), manifest['index'])
+        arrays = {c['name']: self._concat(parts.get(j, []), c) for j, c in cols}
+        return pd.DataFrame(arrays, index=index, columns=[c['name'] for _, c in cols])
+
+    def _kind(self, values):
+        if values.dtype.kind in 'biufcmM':
+            return 'array'
+        elif _is_strings(values):
+            return 'string'
+        return 'pickle'
+
+    def _encode(self, values, kind):
+        if kind == 'array':
+            return [np.ascontiguousarray(values).tobytes()]
+
+        elif kind == 'string':
+            # Nulls are coded as -1.
+            codes, uniques = pd.factorize(values)
+            encoded = [u.encode('utf-8') for u in uniques]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(e) for e in encoded], out=offsets[1:])
+            return [codes.astype(np.int32).tobytes(), offsets.tobytes(), b''.join(encoded)]
+
+        else:
+            return [pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)]
+
+    def _decode(self, buffers, col):
+        if col['kind'] == 'array':
+            return np.frombuffer(buffers[0], dtype=np.dtype(col['dtype']))
+
+        elif col['kind'] == 'string':
+            codes = np.frombuffer(buffers[0], dtype=np.int32)
+            offsets = np.frombuffer(buffers[1], dtype=np.int64)
+            chars = buffers[2]
+
+            # The last entry is for nulls (code -1).
+            uniques = np.empty(len(offsets), dtype=object)
+            for k, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+                uniques[k] = chars[start:end].decode('utf-8')
+            return uniques[codes]
+
+        else:
+            return pickle.loads(buffers[0])
+
+    def _concat(self, parts, col):
+        if not parts:
+            return np.empty(0, dtype=np.dtype(col['dtype']) if col['kind'] == 'array' else object)
+        return np.concatenate(parts)
+
+
+class ArrayBackend():
+    """
+    Stores NumPy arrays and scipy sparse matrices as raw `.npy` buffers,
+    so they can be defrosted with `mmap_mode` and shared through the page cache
+    by several processes, rather than each holding its own copy.
+    """
+    ext = '.arr'
+    dtype = 'other'
+    version = 1
+
+    # The buffers making up each sparse format.
+    buffers = {
+        'csr': ['data', 'indices', 'indptr'],
+        'csc': ['data', 'indices', 'indptr'],
+        'coo': ['data', 'row', 'col']
+    }
+
+    def save(self, data, fpath):
+        if not os.path.exists(fpath):
+            os.makedirs(fpath)
+
+        manifest = {'format': 'arrays', 'version': self.version}
+        if sparse.issparse(data) and data.format in self.buffers:
+            manifest['kind'] = data.format
+            manifest['shape'] = list(data.shape)
+            for name in self.buffers[data.format]:
+                np.save(os.path.join(fpath, name + '.npy'), getattr(data, name))
+
+        elif isinstance(data, np.ndarray) and data.dtype.kind != 'O':
+            manifest['kind'] = 'ndarray'
+            np.save(os.path.join(fpath, 'array.npy'), np.asarray(data))
+
+        else:
+            manifest['kind'] = 'pickle'
+            joblib.dump(data, os.path.join(fpath, 'data.pkl'))
+
+        with open(os.path.join(fpath, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def load(self, fpath, columns=None, mmap_mode=None):
+        with open(os.path.join(fpath, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+
+        kind = manifest['kind']
+        if kind in self.buffers:
+            bufs = [np.load(os.path.join(fpath, name + '.npy'), mmap_mode=mmap_mode)
+                    for name in self.buffers[kind]]
+            shape = tuple(manifest['shape'])
+            if kind == 'coo':
+                data, row, col = bufs
+                return sparse.coo_matrix((data, (row, col)), shape=shape, copy=False)
+            matrix = sparse.csr_matrix if kind == 'csr' else sparse.csc_matrix
+            return matrix(tuple(bufs), shape=shape, copy=False)
+
+        elif kind == 'ndarray':
+            return np.load(os.path.join(fpath, 'array.npy'), mmap_mode=mmap_mode)
+
+        else:
+            return joblib.load(os.path.join(fpath, 'data.pkl'), mmap_mode=mmap_mode)
+
+
+class PickleBackend():
+    ext = '.pkl'
+    dtype = 'other'
+
+    def save(self, data, fpath):
+        joblib.dump(data, fpath)
+
+    def load(self, fpath, columns=None, mmap_mode=None):
+        return joblib.load(fpath, mmap_mode=mmap_mode)
+
+
+backends = {
+    'csv': CSVBackend(),
+    'columnar': ColumnarBackend(),
+    'chunked': ChunkedBackend(),
+    'arrays': ArrayBackend(),
+    'pickle': PickleBackend()
+}
+
+
+def backend_for(fpath):
+    """
+    Returns the backend for a path, based on its extension.
+    """
+    ext = os.path.splitext(fpath.rstrip('/'))[1]
+    for backend in backends.values():
+        if backend.ext == ext:
+            return backend
+    raise ValueError('No storage backend for extension "{0}"'.format(ext))
+
+
+def save(data, fpath):
+    """
+    Saves data atomically: it's written to a temporary path next to `fpath`,
+    then renamed, so a crashed write never leaves a truncated freeze behind.
+    """
+    tmp = temp_path(fpath)
+    try:
+        backend_for(fpath).save(data, tmp)
+        replace(tmp, fpath)
+    except BaseException:
+        remove(tmp)
+        raise
+
+
+def temp_path(fpath):
+    """
+    A temporary path for writing `fpath`, with the same extension (so the same backend).
+    """
+    fdir, name = os.path.split(fpath.rstrip('/'))
+    return os.path.join(fdir, '{0}{1}-{2}'.format(tmp_prefix, os.getpid(), name))
+
+
+def abandoned(fpath, grace):
+    """
+    Whether a temporary path (see `temp_path`) was left behind by a writer which is gone:
+    it's older than `grace` seconds and its writer's pid isn't a live process on this machine.
+    Both must hold, since the data root may be shared with other processes (or machines)
+    which are still writing.
+    """
+    try:
+        if time.time() - os.path.getmtime(fpath) < grace:
+            return False
+    except OSError:
+        return False
+
+    pid = os.path.basename(fpath.rstrip('/'))[len(tmp_prefix):].split('-', 1)[0]
+    if not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # e.g. the process exists but belongs to another user.
+        return False
+    return False
+
+
+def replace(src, dest):
+    """
+    Moves `src` to `dest`, replacing it. Files are replaced atomically; an existing
+    directory is removed first, so `dest` is briefly missing but never partial.
+    """
+    if os.path.isdir(dest) and not os.path.islink(dest):
+        shutil.rmtree(dest)
+    os.replace(src, dest)
+
+
+def remove(fpath):
+    """
+    Removes a freeze (a file or a directory), if it exists.
+    """
+    if os.path.isdir(fpath):
+        shutil.rmtree(fpath)
+    elif os.path.exists(fpath):
+        os.remove(fpath)
+
+
+def size(fpath):
+    """
+    The size of a freeze in bytes (the total of its files, for directory-based backends).
+    """
+    if not os.path.isdir(fpath):
+        return os.path.getsize(fpath)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(fpath) for name in names)
+
+
+def load(fpath, columns=None, mmap_mode=None):
+    return backend_for(fpath).load(fpath, columns=columns, mmap_mode=mmap_mode)
+
+
+def migrate(src, dest):
+    """
+    Converts a freeze from one backend to another, e.g. an old `.csv` to `.cols`
+    or an old `.pkl` to `.arr`.
+    The source is removed once the destination is written.
+    """
+    save(load(src), dest)
+    remove(src)
+
+
+def digest(fpath, block_size=2**20):
+    """
+    An md5 digest of a freeze's content (every file, for directory-based backends).
+    """
+    if os.path.isdir(fpath):
+        files = sorted(os.path.relpath(os.path.join(root, name), fpath)
+                       for root, _, names in os.walk(fpath) for name in names)
+    else:
+        files = ['']
+
+    md5 = hashlib.md5()
+    for name in files:
+        md5.update(name.encode('utf-8'))
+        with open(os.path.join(fpath, name) if name else fpath, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                md5.update(block)
+    return md5.hexdigest()
+
+
+def _is_strings(values):
+    """
+    Whether an object array holds only strings (and nulls).
+    """
+    if values.dtype.kind == 'U':
+        return True
+    if values.dtype.kind != 'O':
+        return False
+    nulls = pd.isnull(values)
+    return all(isinstance(v, str) for v in values[~nulls])
@@ -2,7 +2,20 @@
 Handles vectorizing of documents.
 """
 
+import os
+import re
+import html
 import string
+import fcntl
+import shelve
+import hashlib
+import numbers
+from collections import Counter
+from functools import lru_cache
+from multiprocessing import Pool
+
+import numpy as np
+from scipy import sparse
 
 from sklearn.feature_extraction.text import TfidfTransformer, CountVectorizer, HashingVectorizer
 from sklearn.decomposition import TruncatedSVD
@@ -13,6 +26,10 @@ from nltk.tokenize import sent_tokenize, word_tokenize
 from nltk.stem.wordnet import WordNetLemmatizer
 from nltk.corpus import stopwords
 
+import config
+from util.logging import log
+from util import profiling
+
 
 class Vectorizer():
     def __init__(self, hash=False):
@@ -41,22 +58,185 @@ class Vectorizer():
         self.pipeline = Pipeline(args)
 
     def vectorize(self, docs, train=False):
-        if train:
-            return self.pipeline.fit_transform(docs)
-        else:
-            return self.pipeline.transform(docs)
+        """
+        Vectorizes the documents, first training the pipeline on them if `train` is true.
+        """
+        return self._run('fit_transform' if train else 'transform', docs)
+
+    def fit(self, docs):
+        """
+        Trains the pipeline on the documents, without vectorizing them.
+        """
+        self._run('fit', docs)
+        return self
+
+    def fit_stream(self, chunks, sample_size=None, seed=0):
+        """
+        Trains the pipeline on a stream of document chunks, without holding
+        all the documents (or their term matrix) in memory.
+
+        Document frequencies are counted chunk by chunk, then the vocabulary (for the count vectorizer)
+        and the idf weights are set from them directly, as `fit` would have set them.
+        The feature reducer (SVD), if any, is fit on a reservoir sample of the documents.
+
+        Args:
+            | chunks (iterable)     -- iterables of documents
+            | sample_size (int)     -- the size of the SVD's sample, defaults to `config.vectorizing`
+            | seed (int)            -- random seed for the sample
+        """
+        steps = self.pipeline.named_steps
+        vectr = steps['vectorizer']
+        hashed = isinstance(vectr, HashingVectorizer)
+        reduce = 'feature_reducer' in steps
+        sample_size = sample_size or config.vectorizing['svd_sample']
+
+        rs = np.random.RandomState(seed)
+        sample = []
+        n_docs = 0
+        df = np.zeros(vectr.n_features, dtype=np.int64) if hashed else Counter()
+        analyze = vectr.build_analyzer()
+
+        for i, docs in enumerate(chunks):
+            docs = list(docs)
+            log.info('Counting terms in chunk {0} ({1} documents)...'.format(i, len(docs)))
+            with profiling.span('vectorizer.fit_stream.chunk', rows=len(docs)):
+                self._prefetch(docs)
+                try:
+                    if hashed:
+                        X = vectr.transform(docs)
+                        X.eliminate_zeros()
+                        df += np.bincount(X.indices, minlength=vectr.n_features)
+                    else:
+                        for doc in docs:
+                            df.update(set(analyze(doc)))
+                finally:
+                    vectr.tokenizer.clear()
+
+            if reduce:
+                # Reservoir sampling, so every document is equally likely to be sampled.
+                for doc in docs:
+                    if len(sample) < sample_size:
+                        sample.append(doc)
+                    else:
+                        j = rs.randint(0, n_docs + 1)
+                        if j < sample_size:
+                            sample[j] = doc
+                    n_docs += 1
+            else:
+                n_docs += len(docs)
+
+        if not hashed:
+            df = self._set_vocabulary(vectr, df, n_docs)
+        _set_idf(steps['tfidf'], df, n_docs)
+
+        if reduce:
+            log.info('Fitting feature reducer on {0} of {1} documents...'.format(len(sample), n_docs))
+            X = steps['tfidf'].transform(self._count(sample))
+            steps['feature_reducer'].fit(X)
+            steps['normalizer'].fit(steps['feature_reducer'].transform(X))
+        return self
+
+    def _count(self, docs):
+        """
+        The count (or hashed) term matrix of the documents.
+        """
+        vectr = self.pipeline.named_steps['vectorizer']
+        self._prefetch(docs)
+        try:
+            return vectr.transform(docs)
+        finally:
+            vectr.tokenizer.clear()
+
+    def _set_vocabulary(self, vectr, df, n_docs):
+        """
+        Sets the count vectorizer's vocabulary from the document frequencies,
+        applying its `min_df`/`max_df` limits, and returns the vocabulary's document frequencies.
+        """
+        max_df = vectr.max_df if isinstance(vectr.max_df, numbers.Integral) else vectr.max_df * n_docs
+        min_df = vectr.min_df if isinstance(vectr.min_df, numbers.Integral) else vectr.min_df * n_docs
+        terms = sorted(t for t, n in df.items() if min_df <= n <= max_df)
+        if not terms:
+            raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+
+        vectr.vocabulary_ = {t: i for i, t in enumerate(terms)}
+        vectr.fixed_vocabulary_ = False
+        vectr.stop_words_ = set(df.keys()) - set(terms)
+        return np.array([df[t] for t in terms], dtype=np.int64)
+
+    def _run(self, method, docs):
+        batched = config.tokenizing['n_jobs'] > 1 or config.tokenizing['persist']
+        if batched:
+            docs = list(docs)
+
+        with profiling.span('vectorizer.{0}'.format(method), rows=profiling.num_rows(docs)):
+            if batched:
+                self._prefetch(docs)
+
+            try:
+                return getattr(self.pipeline, method)(docs)
+            finally:
+                if batched:
+                    self.pipeline.named_steps['vectorizer'].tokenizer.clear()
+
+    def _prefetch(self, docs):
+        """
+        Batch-tokenize the documents as the vectorizer will see them,
+        i.e. after its preprocessing (lowercasing, etc).
+        """
+        vectr = self.pipeline.named_steps['vectorizer']
+        preprocess = vectr.build_preprocessor()
+        vectr.tokenizer.prefetch(preprocess(vectr.decode(doc)) for doc in docs)
+
+
+def _set_idf(tfidf, df, n_docs):
+    """
+    Sets a fitted `TfidfTransformer`'s idf weights from document frequencies,
+    as its `fit` would compute them.
+    """
+    df = df + int(tfidf.smooth_idf)
+    n = n_docs + int(tfidf.smooth_idf)
+    idf = np.log(float(n) / df) + 1.0
+    try:
+        tfidf.idf_ = idf
+    except AttributeError:
+        # Older versions of sklearn only compute `idf_` from `_idf_diag`.
+        tfidf._idf_diag = sparse.spdiags(idf, diags=0, m=len(idf), n=len(idf), format='csr')
 
 
 class Tokenizer():
     """
     Custom tokenizer for vectorization.
     Uses Lemmatization.
+
+    Besides tokenizing single documents (as the sklearn vectorizers do),
+    documents can be tokenized in batches with `prefetch`, which fans out over
+    a process pool and (optionally) persists token streams keyed by document hash.
+    Prefetched documents are then served from memory when the vectorizer calls the tokenizer.
     """
+    # Bump this whenever tokenization changes, to invalidate persisted token streams.
+    version = 1
+
     def __init__(self):
         self.lemmr = WordNetLemmatizer()
+        self._tokens = {}
 
     def __call__(self, doc):
-        return self.tokenize(doc, lemmr=self.lemmr)
+        if self._tokens:
+            try:
+                return self._tokens[doc_key(doc, self.version)]
+            except KeyError:
+                pass
+        return self.tokenize(doc)
+
+    def __getstate__(self):
+        # Prefetched tokens are transient, don't pickle them.
+        state = self.__dict__.copy()
+        state['_tokens'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('_tokens', {})
 
     def tokenize(self, doc, **kwargs):
         """
@@ -64,14 +244,15 @@ class Tokenizer():
 
         Args:
             | doc (str)                 -- the text document to process.
+            | lemmr (Lemmatizer)        -- optional, a lemmatizer to use instead of the cached one.
 
         Returns:
             | list                      -- the list of tokens.
         """
 
         tokens = []
-        lemmr = kwargs.get('lemmr', WordNetLemmatizer())
-        stops = set(list(string.punctuation) + stopwords.words('english'))
+        lemmatize = kwargs['lemmr'].lemmatize if 'lemmr' in kwargs else _lemmatize
+        stops = stopword_set()
 
         # Tokenize
         for sentence in sent_tokenize(doc):
@@ -82,10 +263,152 @@ class Tokenizer():
                     continue
 
                 # Lemmatize
-                lemma = lemmr.lemmatize(token.lower())
+                lemma = lemmatize(token.lower())
                 tokens.append(lemma)
         return tokens
 
+    def tokenize_batch(self, docs, n_jobs=None, chunk_size=None, persist=None):
+        """
+        Tokenizes many documents.
+
+        Duplicate documents are only tokenized once, and documents which have
+        persisted token streams are not tokenized again.
+
+        Args:
+            | docs (iterable)           -- the text documents to process.
+            | n_jobs (int)              -- number of worker processes, defaults to `config.tokenizing`
+            | chunk_size (int)          -- number of documents sent to a worker at a time
+            | persist (bool)            -- whether to load/save token streams from/to disk
+
+        Returns:
+            | list                      -- list of token lists, one per document.
+        """
+        opts = config.tokenizing
+        n_jobs = n_jobs or opts['n_jobs']
+        chunk_size = chunk_size or opts['chunk_size']
+        persist = opts['persist'] if persist is None else persist
+
+        docs = list(docs)
+        keys = [doc_key(doc, self.version) for doc in docs]
+        tokens = {}
+
+        if persist:
+            with TokenStore() as store:
+                tokens.update(store.get_many(set(keys)))
+
+        todo = {}
+        for key, doc in zip(keys, docs):
+            if key not in tokens:
+                todo[key] = doc
+
+        if todo:
+            log.info('Tokenizing {0} documents ({1} cached)...'.format(len(todo), len(tokens)))
+            todo_keys, todo_docs = list(todo.keys()), list(todo.values())
+            if n_jobs > 1 and len(todo_docs) > chunk_size:
+                with Pool(n_jobs) as pool:
+                    results = pool.map(_tokenize, todo_docs, chunksize=chunk_size)
+            else:
+                results = [self.tokenize(doc) for doc in todo_docs]
+            fresh = dict(zip(todo_keys, results))
+            tokens.update(fresh)
+
+            if persist:
+                with TokenStore() as store:
+                    store.put_many(fresh)
+
+        return [tokens[key] for key in keys]
+
+    def prefetch(self, docs, **kwargs):
+        """
+        Batch-tokenizes the documents ahead of the vectorizer,
+        which will then look up their tokens rather than tokenizing one at a time.
+        Takes the same kwargs as `tokenize_batch`.
+        """
+        docs = list(docs)
+        token_lists = self.tokenize_batch(docs, **kwargs)
+        self._tokens = {doc_key(doc, self.version): tokens for doc, tokens in zip(docs, token_lists)}
+
+    def clear(self):
+        self._tokens = {}
+
+
+class TokenStore():
+    """
+    Persists token streams to disk, keyed by document hash.
+    Use it as a context manager so the underlying shelf is closed.
+
+    The shelf is only open while an exclusive lock on `<path>.lock` is held,
+    since shelves don't support concurrent access and several processes
+    (e.g. parallel featurizer workers, or the server and `warm_cache`) may tokenize at once.
+    """
+    def __init__(self, path=None):
+        self.path = path or os.path.join(config.data_root, 'tokens', 'tokens')
+
+    def __enter__(self):
+        fdir = os.path.dirname(self.path)
+        if not os.path.exists(fdir):
+            os.makedirs(fdir)
+        self.lock = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            self.shelf = shelve.open(self.path)
+        except BaseException:
+            self._unlock()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.shelf.close()
+        finally:
+            self._unlock()
+
+    def _unlock(self):
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+
+    def get_many(self, keys):
+        return {key: self.shelf[key] for key in keys if key in self.shelf}
+
+    def put_many(self, tokens):
+        for key, toks in tokens.items():
+            self.shelf[key] = toks
+
+
+def doc_key(doc, version=Tokenizer.version):
+    """
+    Hash key identifying a document's token stream.
+    """
+    return hashlib.md5('{0}:{1}'.format(version, doc).encode('utf-8')).hexdigest()
+
+
+_stops = None
+def stopword_set():
+    """
+    The set of tokens to skip (punctuation and English stopwords), built once per process.
+    """
+    global _stops
+    if _stops is None:
+        _stops = frozenset(list(string.punctuation) + stopwords.words('english'))
+    return _stops
+
+
+_lemmr = WordNetLemmatizer()
+@lru_cache(maxsize=config.tokenizing['lemma_cache_size'])
+def _lemmatize(token):
+    return _lemmr.lemmatize(token)
+
+
+_tokenizer = None
+def _tokenize(doc):
+    """
+    Tokenizes a single document in a worker process.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = Tokenizer()
+    return _tokenizer.tokenize(doc)
+
 
 
 from html.parser import HTMLParser
@@ -108,18 +431,60 @@ def strip_tags(html):
     return s.get_data()
 
 
+_basic_entities = {'&#39;': "'", '&quot;': '"', '&gt;': '>', '&lt;': '<', '&amp;': '&'}
+_basic_entity_re = re.compile('|'.join(_basic_entities.keys()))
+
 def html_decode(s):
     """
     Returns the ASCII decoded version of the given HTML string. This does
     NOT remove normal HTML tags like <p>.
     from: <http://stackoverflow.com/a/275246/1097920
+
+    Decodes in a single pass, which gives the same result as replacing
+    each entity in turn (with `&amp;` last).
+    """
+    if '&' not in s:
+        return s
+    return _basic_entity_re.sub(lambda m: _basic_entities[m.group(0)], s)
+
+
+# Tags (including comments/doctypes), raw or escaped once,
+# e.g. `<p>` or `&lt;a href=&quot;...&quot;&gt;`. Like `HTMLParser`, a `<` not followed
+# by a letter, `/` or `!` (e.g. "a < b") is text. A `>` in a quoted attribute value
+# (e.g. `<a title="x>y">`) doesn't end a raw tag.
+_tag_re = re.compile(r'<[A-Za-z/!](?:"[^"]*"|\'[^\']*\'|[^\'">])*>|&lt;[A-Za-z/!](?:(?!&gt;)[^<>])*&gt;')
+
+def normalize_html(doc):
+    """
+    Strips tags from an HTML document and decodes all of its entities, in one pass over it.
+
+    The result matches `strip_tags(html_decode(doc))` for markup which is escaped at most once,
+    without building an `HTMLParser` per document.
+    """
+    if not doc:
+        return ''
+    if '<' in doc or '&lt;' in doc:
+        doc = _tag_re.sub('', doc)
+    return html.unescape(doc) if '&' in doc else doc
+
+
+def normalize_html_batch(docs, n_jobs=None, chunk_size=None):
+    """
+    Strips tags and decodes entities for many documents (see `normalize_html`).
+
+    Args:
+        | docs (iterable)           -- the HTML documents (e.g. a list or an array), nulls are treated as empty
+        | n_jobs (int)              -- number of worker processes for large batches, defaults to `config.tokenizing`
+        | chunk_size (int)          -- number of documents sent to a worker at a time
+
+    Returns:
+        | list                      -- the normalized documents
     """
-    for code in (
-            ("'", '&#39;'),
-            ('"', '&quot;'),
-            ('>', '&gt;'),
-            ('<', '&lt;'),
-            ('&', '&amp;')
-        ):
-        s = s.replace(code[1], code[0])
-    return s
+    n_jobs = n_jobs or config.tokenizing['n_jobs']
+    chunk_size = chunk_size or config.tokenizing['chunk_size']
+
+    docs = [doc if isinstance(doc, str) else '' for doc in docs]
+    if n_jobs > 1 and len(docs) > n_jobs * chunk_size:
+        with Pool(n_jobs) as pool:
+            return pool.map(normalize_html, docs, chunksize=chunk_size)
+    return [normalize_html(doc) for doc in docs]